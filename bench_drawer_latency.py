@@ -0,0 +1,84 @@
+"""
+Floods a receipt JobQueue with receipts while kicking the cash drawer and
+reports the drawer-open latency histogram.  Uses an escpos Dummy printer with a
+simulated per-receipt transfer time, so no hardware or MQTT broker is needed:
+
+    python bench_drawer_latency.py --receipts 200 --receipt-ms 40 --kicks 50
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import threading
+import time
+from formatter import ReceiptFormatter
+
+from job_queue import Job, JobQueue
+from printer_session import PrinterSession
+
+
+def print_receipt(printer, transfer_ms):
+    builder = ReceiptFormatter()
+    builder.center_text("Benchmark receipt")
+    builder.hr()
+    for i in range(20):
+        builder.format_line_item(f"Line item {i}", "$1.00")
+    printer.text(builder.pop())
+    printer.cut()
+    # Stand-in for the time the USB/serial transfer and paper feed take
+    time.sleep(transfer_ms / 1000.0)
+
+
+def kick_drawer(printer):
+    printer.cashdraw(2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--receipts", type=int, default=200)
+    parser.add_argument("--receipt-ms", type=float, default=40)
+    parser.add_argument("--kicks", type=int, default=50)
+    parser.add_argument("--target-ms", type=float, default=100)
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False) as f:
+        f.write("printer:\n    type: Dummy\n")
+    session = PrinterSession("bench", f.name)
+
+    queue = JobQueue(
+        "receipt",
+        depth=options.receipts,
+        priority_target_ms=options.target_ms,
+    )
+    queue.start()
+
+    for i in range(options.receipts):
+        queue.submit(
+            Job(f"receipt-{i}", session.run, print_receipt, options.receipt_ms)
+        )
+
+    # Kick the drawer at evenly spaced points while the flood drains
+    def kicker():
+        interval = options.receipts * options.receipt_ms / options.kicks / 1000.0
+        for i in range(options.kicks):
+            time.sleep(interval)
+            queue.submit(Job(f"drawer-{i}", session.run, kick_drawer), priority=True)
+
+    thread = threading.Thread(target=kicker)
+    thread.start()
+    thread.join()
+    queue.stop()
+    os.unlink(f.name)
+
+    print(queue.run_times)
+    print(queue.priority_times)
+    p99 = queue.priority_times.percentile(99)
+    verdict = "PASS" if p99 <= options.target_ms else "FAIL"
+    print(f"{verdict}: drawer p99 <= {p99:.1f} ms (target {options.target_ms} ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,20 @@ import textwrap
 
 
 class ReceiptFormatter(object):
-    def __init__(self, width=48, margin=2, left_margin=2):
+    def __init__(self, width=48, margin=2, left_margin=2, sink=None, flush_lines=16):
+        """
+        If sink is given the formatter streams: every flush_lines lines (and on
+        flush()) the pending lines are passed to sink(text) and forgotten, so
+        memory stays bounded however long the receipt is.  Concatenating the
+        chunks gives the same text print() would have returned.
+        """
         self.lines = []
         self.width = width
         self.margin = margin
         self.left_margin = left_margin
+        self.sink = sink
+        self.flush_lines = flush_lines
+        self.flushed = False
 
     def print(self):
         return "\n".join(self.lines)
@@ -19,12 +28,27 @@ class ReceiptFormatter(object):
     def clear(self):
         self.lines = []
 
+    def flush(self):
+        """Sends the pending lines to the sink (streaming mode only)."""
+        if self.sink is None or not self.lines:
+            return
+        text = self.pop()
+        if self.flushed:
+            text = "\n" + text
+        self.flushed = True
+        self.sink(text)
+
+    def _add(self, line):
+        self.lines.append(line)
+        if self.sink is not None and len(self.lines) >= self.flush_lines:
+            self.flush()
+
     def ln(self):
-        self.lines.append("")
+        self._add("")
         return ""
 
     def append(self, text):
-        self.lines.append(f"{' '*self.left_margin}{text}")
+        self._add(f"{' '*self.left_margin}{text}")
 
     def format_line_item(self, left, right):
         if len(left) + len(right) + self.margin > self.width:
@@ -34,13 +58,13 @@ class ReceiptFormatter(object):
 
         space_len = self.width - len(left) - len(right) - self.left_margin - 2
         line = f"{' '*self.left_margin}{left}{' '*space_len}  {right}"
-        self.lines.append(line)
+        self._add(line)
         return line
 
     def center_text(self, text):
         space_left = self.left_margin + int((self.width - len(text)) / 2)
         line = f"{' '*space_left}{text}"
-        self.lines.append(line)
+        self._add(line)
         return line
 
     def right_text(self, text):
@@ -48,7 +72,7 @@ class ReceiptFormatter(object):
 
     def wrap(self, text):
         line = textwrap.fill(text, width=self.width)
-        self.lines.append(f"{' '*self.left_margin}{line}")
+        self._add(f"{' '*self.left_margin}{line}")
         return line
 
     def wrap_center(self, text):
@@ -62,7 +86,7 @@ class ReceiptFormatter(object):
         if center:
             return self.center_text(character * width)
         line = character * width
-        self.lines.append(line)
+        self._add(line)
         return line
 
 
@@ -0,0 +1,203 @@
+"""Bounded in-process job queue serviced by worker threads"""
+
+import collections
+import logging
+import threading
+import time
+
+from metrics import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+REJECT = "reject"
+POLICIES = (BLOCK, DROP_OLDEST, REJECT)
+
+
+class QueueFull(Exception):
+    def __init__(self, queue_name, depth):
+        self.queue_name = queue_name
+        self.depth = depth
+
+    def __str__(self):
+        return f"Job queue '{self.queue_name}' is full ({self.depth} jobs)"
+
+
+class Job(object):
+    """A unit of work: func(*args, **kwargs) plus its queue timing."""
+
+    def __init__(self, name, func, *args, **kwargs):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.queued_at = None
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def wait_ms(self):
+        if self.queued_at is None or self.started_at is None:
+            return None
+        return (self.started_at - self.queued_at) * 1000
+
+    @property
+    def run_ms(self):
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return (self.finished_at - self.started_at) * 1000
+
+    def run(self):
+        return self.func(*self.args, **self.kwargs)
+
+    def __repr__(self):
+        return f"<Job {self.name}>"
+
+
+class JobQueue(object):
+    """
+    A bounded FIFO of Jobs run by one or more worker threads.  When the queue
+    is full, policy decides what submit() does:
+
+        block:       wait for a free slot (never use this from a thread that
+                     must keep running, such as the MQTT network loop)
+        drop_oldest: discard the oldest queued job (on_drop is called with it)
+        reject:      raise QueueFull
+
+    Jobs submitted with priority=True (cash drawer kicks) skip the bound and
+    the FIFO: workers run them before any queued job as soon as the current
+    job finishes.  Their end-to-end latency is recorded in priority_times and
+    a warning is logged whenever it exceeds priority_target_ms.
+    """
+
+    def __init__(
+        self,
+        name,
+        depth=32,
+        policy=REJECT,
+        workers=1,
+        on_drop=None,
+        priority_target_ms=100,
+    ):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy '{policy}', expected {POLICIES}")
+        self.name = name
+        self.depth = depth
+        self.policy = policy
+        self.workers = workers
+        self.on_drop = on_drop
+        self.priority_target_ms = priority_target_ms
+
+        self.jobs = collections.deque()
+        self.priority_jobs = collections.deque()
+        self.cond = threading.Condition()
+        self.threads = []
+        self.running = False
+
+        self.wait_times = LatencyHistogram(f"{name} queue wait")
+        self.run_times = LatencyHistogram(f"{name} run time")
+        self.priority_times = LatencyHistogram(f"{name} priority latency")
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "dropped": 0}
+
+    def start(self):
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._worker, name=f"{self.name}-worker-{i}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, wait=True):
+        """Stops the workers once the jobs already queued have run."""
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if wait:
+            for thread in self.threads:
+                thread.join()
+        self.threads = []
+
+    def __len__(self):
+        with self.cond:
+            return len(self.jobs) + len(self.priority_jobs)
+
+    def submit(self, job, priority=False):
+        dropped = None
+        with self.cond:
+            if priority:
+                job.queued_at = time.monotonic()
+                self.priority_jobs.append(job)
+                self.stats["submitted"] += 1
+                self.cond.notify_all()
+                return job
+
+            while len(self.jobs) >= self.depth:
+                if self.policy == REJECT:
+                    raise QueueFull(self.name, self.depth)
+                if self.policy == DROP_OLDEST:
+                    dropped = self.jobs.popleft()
+                    self.stats["dropped"] += 1
+                    break
+                self.cond.wait()
+
+            job.queued_at = time.monotonic()
+            self.jobs.append(job)
+            self.stats["submitted"] += 1
+            self.cond.notify_all()
+
+        if dropped is not None:
+            logger.warning(f"Queue '{self.name}' full, dropped {dropped!r}")
+            if self.on_drop:
+                self.on_drop(dropped)
+        return job
+
+    def _next_job(self):
+        with self.cond:
+            while not (self.jobs or self.priority_jobs):
+                if not self.running:
+                    return None, False
+                self.cond.wait()
+            if self.priority_jobs:
+                return self.priority_jobs.popleft(), True
+            job = self.jobs.popleft()
+            # Wake anyone blocked in submit() waiting for a free slot
+            self.cond.notify_all()
+            return job, False
+
+    def _worker(self):
+        while True:
+            job, priority = self._next_job()
+            if job is None:
+                return
+
+            job.started_at = time.monotonic()
+            outcome = "completed"
+            try:
+                job.run()
+            except Exception:
+                outcome = "failed"
+                logger.exception(f"Job {job.name} failed")
+            job.finished_at = time.monotonic()
+
+            with self.cond:
+                self.stats[outcome] += 1
+
+            self.wait_times.observe(job.wait_ms)
+            self.run_times.observe(job.run_ms)
+            logger.debug(
+                f"Job {job.name} waited {job.wait_ms:.1f} ms, ran {job.run_ms:.1f} ms"
+            )
+
+            if priority:
+                latency = job.wait_ms + job.run_ms
+                self.priority_times.observe(latency)
+                if latency > self.priority_target_ms:
+                    logger.warning(
+                        f"Priority job {job.name} took {latency:.1f} ms "
+                        f"(target {self.priority_target_ms} ms)"
+                    )
@@ -0,0 +1,237 @@
+"""Caches the receipt logo as ready-to-send ESC/POS bytes"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import struct
+import threading
+
+from escpos.image import EscposImage
+
+from printer_session import after_write, buffer_for
+
+logger = logging.getLogger(__name__)
+
+GS = b"\x1d"
+
+
+def profile_name(printer):
+    """Returns a filesystem-safe name for the printer's capability profile."""
+    name = printer.profile.profile_data.get("name", "default")
+    return re.sub(r"[^0-9A-Za-z_.-]", "_", name)
+
+
+def media_width(printer):
+    try:
+        return int(printer.profile.profile_data["media"]["width"]["pixels"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class LogoCache(object):
+    """
+    Converts the logo image once per (printer profile, image impl, media width)
+    and keeps the resulting ESC/POS bytes in memory, and optionally on disk in
+    cache_dir.  Entries are keyed by the SHA-256 of the image file, which is
+    recomputed whenever the file's mtime or size changes.
+    """
+
+    def __init__(
+        self, path="logo.png", cache_dir=None, impl="bitImageRaster", center=False
+    ):
+        self.path = path
+        self.cache_dir = cache_dir
+        self.impl = impl
+        self.center = center
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.file_state = None
+        self.digest = None
+        self.stats = {"hits": 0, "disk_hits": 0, "conversions": 0, "invalidations": 0}
+
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _check_file(self):
+        """Rehashes the image if it changed on disk; returns the current digest."""
+        st = os.stat(self.path)
+        state = (st.st_mtime_ns, st.st_size)
+        if state != self.file_state:
+            with open(self.path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            if self.digest is not None and digest != self.digest:
+                logger.info(f"{self.path} changed, invalidating cached logo")
+                self.stats["invalidations"] += 1
+                self.entries = {}
+            self.file_state = state
+            self.digest = digest
+        return self.digest
+
+    def current_digest(self):
+        with self.lock:
+            return self._check_file()
+
+    def _disk_path(self, key):
+        digest, profile, impl, width, center = key
+        center = "center" if center else "left"
+        return os.path.join(
+            self.cache_dir, f"logo-{digest[:16]}-{profile}-{impl}-{width}-{center}.bin"
+        )
+
+    def _convert(self, printer):
+        buffer = buffer_for(printer)
+        buffer.image(self.path, impl=self.impl, center=self.center)
+        return buffer.output
+
+    def get(self, printer):
+        """Returns the ESC/POS bytes that print the logo on this printer."""
+        with self.lock:
+            digest = self._check_file()
+            key = (
+                digest,
+                profile_name(printer),
+                self.impl,
+                media_width(printer),
+                self.center,
+            )
+
+            data = self.entries.get(key)
+            if data is not None:
+                self.stats["hits"] += 1
+                return data
+
+            if self.cache_dir:
+                try:
+                    with open(self._disk_path(key), "rb") as f:
+                        data = f.read()
+                    self.stats["disk_hits"] += 1
+                except FileNotFoundError:
+                    pass
+
+            if data is None:
+                logger.debug(f"Converting {self.path} for profile {key[1]}")
+                data = self._convert(printer)
+                self.stats["conversions"] += 1
+                if self.cache_dir:
+                    disk_path = self._disk_path(key)
+                    with open(disk_path + ".tmp", "wb") as f:
+                        f.write(data)
+                    os.replace(disk_path + ".tmp", disk_path)
+
+            self.entries[key] = data
+            return data
+
+    def print_logo(self, printer):
+        printer._raw(self.get(printer))
+
+
+def graphics_command(payload):
+    """Wraps a GS ( L function payload, using GS 8 L when it exceeds 64 KiB."""
+    if len(payload) <= 0xFFFF:
+        return GS + b"(L" + struct.pack("<H", len(payload)) + payload
+    return GS + b"8L" + struct.pack("<I", len(payload)) + payload
+
+
+class NVLogo(object):
+    """
+    Stores the logo in the printer's NV graphics memory (GS ( L function 67)
+    and prints it by key reference (function 69), so each receipt sends a few
+    bytes instead of the whole raster.  The key is derived from the image
+    hash; the key uploaded to each printer is recorded in state_path so the
+    NV memory, which has a limited number of write cycles, is only rewritten
+    when the image changes.  Printers whose profile lacks the "graphics"
+    feature get the raster logo from the LogoCache instead.
+
+    An upload rendered into a buffer only reaches the printer when that
+    buffer is written, so it is saved to state_path then (see
+    printer_session.after_write).  Until then later receipts print by the new
+    key too; if the buffer is discarded, the device's last saved upload is
+    restored and the next receipt uploads again.
+    """
+
+    def __init__(self, cache, state_path="nv-logo.json"):
+        self.cache = cache
+        self.state_path = state_path
+        self.lock = threading.Lock()
+        self.stats = {"nv_prints": 0, "uploads": 0, "fallbacks": 0}
+        # What each printer has been sent (state), and what is known to have
+        # reached it (saved, as in state_path)
+        try:
+            with open(state_path) as f:
+                self.saved = json.load(f)
+        except FileNotFoundError:
+            self.saved = {}
+        self.state = dict(self.saved)
+
+    @staticmethod
+    def key_code(digest):
+        """Maps an image hash to a printable two byte key (kc1 kc2)."""
+        raw = bytes.fromhex(digest[:4])
+        return bytes((32 + raw[0] % 95, 32 + raw[1] % 95))
+
+    def _save_state(self):
+        with open(self.state_path + ".tmp", "w") as f:
+            json.dump(self.saved, f, indent=2)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def _upload(self, printer, key, old_key=None):
+        im = EscposImage(self.cache.path)
+        width = media_width(printer)
+        if self.cache.center and width:
+            im.center(width)
+
+        commands = []
+        if old_key:
+            commands.append(graphics_command(b"0B" + old_key))
+        header = (
+            b"0C0" + key + b"\x01" + struct.pack("<HH", im.width_bytes * 8, im.height)
+        )
+        commands.append(graphics_command(header + b"1" + im.to_raster_format()))
+        printer._raw(b"".join(commands))
+        self.stats["uploads"] += 1
+
+    def print_logo(self, printer):
+        if not printer.profile.supports("graphics"):
+            self.stats["fallbacks"] += 1
+            self.cache.print_logo(printer)
+            return
+
+        device = getattr(printer, "session_name", "default")
+        digest = self.cache.current_digest()
+        key = self.key_code(digest)
+        upload = None
+        with self.lock:
+            stored = self.state.get(device, {})
+            if stored.get("digest") != digest:
+                old_key = stored.get("key")
+                old_key = old_key.encode("ascii") if old_key else None
+                logger.info(f"Uploading {self.cache.path} to NV memory of '{device}'")
+                self._upload(printer, key, old_key)
+                upload = {"digest": digest, "key": key.decode("ascii")}
+                self.state[device] = upload
+
+        if upload is not None:
+            after_write(
+                printer,
+                lambda: self._written(device, upload),
+                lambda: self._discarded(device, upload),
+            )
+        printer._raw(graphics_command(b"0E" + key + b"\x01\x01"))
+        self.stats["nv_prints"] += 1
+
+    def _written(self, device, upload):
+        with self.lock:
+            self.saved[device] = upload
+            self._save_state()
+
+    def _discarded(self, device, upload):
+        with self.lock:
+            if self.state.get(device) is not upload:
+                return
+            logger.warning(f"NV logo upload to '{device}' was not printed")
+            if device in self.saved:
+                self.state[device] = self.saved[device]
+            else:
+                del self.state[device]
@@ -0,0 +1,70 @@
+"""Lightweight in-process latency metrics"""
+
+import bisect
+import threading
+
+
+class LatencyHistogram(object):
+    """Fixed-bucket histogram of latencies, recorded in milliseconds."""
+
+    BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, name, buckets=BUCKETS):
+        self.name = name
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # One extra slot for everything above the largest bucket
+            self.counts = [0] * (len(self.buckets) + 1)
+            self.count = 0
+            self.total = 0.0
+            self.max = 0.0
+
+    def observe(self, ms):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+            self.count += 1
+            self.total += ms
+            self.max = max(self.max, ms)
+
+    def observe_since(self, start, end):
+        """Records the time between two time.monotonic() readings."""
+        self.observe((end - start) * 1000)
+
+    def percentile(self, p):
+        """
+        Returns the upper bound of the bucket containing the p-th percentile,
+        or the observed maximum if it falls in the overflow bucket.
+        """
+        with self.lock:
+            if self.count == 0:
+                return 0.0
+            target = self.count * p / 100.0
+            seen = 0
+            for i, n in enumerate(self.counts):
+                seen += n
+                if seen >= target:
+                    if i < len(self.buckets):
+                        return min(float(self.buckets[i]), self.max)
+                    return self.max
+            return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 2) if self.count else 0.0,
+            "p50": round(self.percentile(50), 2),
+            "p95": round(self.percentile(95), 2),
+            "p99": round(self.percentile(99), 2),
+            "max": round(self.max, 2),
+        }
+
+    def __str__(self):
+        s = self.summary()
+        return (
+            f"{self.name}: n={s['count']} mean={s['mean']}ms p50<={s['p50']}ms "
+            f"p95<={s['p95']}ms p99<={s['p99']}ms max={s['max']}ms"
+        )
@@ -1,12 +1,19 @@
+import base64
 import json
 import logging
+import time
 from formatter import ReceiptFormatter
 
 import paho.mqtt.client as mqtt
-from escpos.config import Config
 
 import printing
 import settings
+from job_queue import BLOCK, REJECT, Job, JobQueue, QueueFull
+from logo import LogoCache, NVLogo
+from metrics import LatencyHistogram
+from printer_session import SessionManager, buffer_for
+from receipt_layout import AUDIT_SLIP_TEMPLATE, RECEIPT_TEMPLATE, ReceiptLayout
+from workspace import Workspace
 
 # create logger
 logger = logging.getLogger(__name__)
@@ -29,6 +36,55 @@ logger.debug(
     "FIXME: Importing the escpos library clobbers logging here for some reason"
 )
 
+# Receipt printers stay open between messages; see printer_session.py
+sessions = SessionManager(getattr(settings, "RECEIPT_PRINTERS", None))
+
+# logo.png is converted to ESC/POS once and reused for every receipt
+logo = LogoCache(**getattr(settings, "LOGO_SETTINGS", {}))
+if getattr(settings, "LOGO_STORE_IN_PRINTER", False):
+    logo = NVLogo(logo, getattr(settings, "LOGO_NV_STATE_FILE", "nv-logo.json"))
+
+# Receipt templates are compiled once; only payload-dependent sections are
+# formatted per receipt.  See receipt_layout.py for the section names.
+receipt_template = getattr(settings, "RECEIPT_TEMPLATE", RECEIPT_TEMPLATE)
+layouts = {
+    "cash": ReceiptLayout(
+        receipt_template, settings.BOTTOM_TEXT_CASH, **settings.FORMATTER_SETTINGS
+    ),
+    "credit": ReceiptLayout(
+        receipt_template, settings.BOTTOM_TEXT_CREDIT, **settings.FORMATTER_SETTINGS
+    ),
+    "audit_slip": ReceiptLayout(
+        getattr(settings, "AUDIT_SLIP_TEMPLATE", AUDIT_SLIP_TEMPLATE),
+        **settings.FORMATTER_SETTINGS,
+    ),
+}
+
+# Badges are rendered by wkhtmltopdf per job unless a persistent renderer is
+# configured; see printing.PersistentBackend
+if getattr(settings, "BADGE_RENDER_BACKEND", "wkhtmltopdf") == "persistent":
+    printing.default_backend = printing.PersistentBackend(
+        **getattr(settings, "BADGE_RENDER_SETTINGS", {})
+    )
+
+# Rendered badge PDFs are kept for previews followed by prints, and reprints
+if getattr(settings, "BADGE_PDF_CACHE", None):
+    printing.pdf_cache = printing.PdfCache(**settings.BADGE_PDF_CACHE)
+
+# Badge HTML, PDFs and images are written to per-job directories in RAM and
+# removed when the job finishes
+workspace = Workspace(**getattr(settings, "BADGE_WORKSPACE", {}))
+
+# Topics we publish to under our own base topic
+REPORT_TOPICS = ("error", "print/progress", "print/status", "preview/image")
+
+# Time from a preview message arriving to its image being published
+preview_times = LatencyHistogram("badge preview")
+
+# Messages are handed to these queues so the paho network loop never waits on
+# formatting, device I/O or badge rendering; see start_queues()
+queues = {}
+
 
 # The callback for when the client receives a CONNACK response from the server.
 def on_connect(client, userdata, flags, rc):
@@ -45,11 +101,41 @@ def on_message(client, userdata, msg):
     logging.debug("Got message:")
     logging.debug(msg.topic + " " + str(msg.payload))
 
-    receipt_printer = get_printer()
+    if msg.topic in [get_topic(report) for report in REPORT_TOPICS]:
+        # Our own reports, echoed back by the wildcard subscription
+        return
+
+    if msg.topic in (get_topic("preview"), get_topic("print")):
+        queue = queues["badge"]
+    else:
+        queue = queues["receipt"]
+
+    # Drawer kicks jump ahead of queued receipts and run as soon as the
+    # current job is done with the printer; so do preview images, which the
+    # operator is waiting on
+    priority = msg.topic in (get_topic("cash_drawer"), get_topic("no_sale")) or (
+        msg.topic == get_topic("preview") and preview_mode() == "image"
+    )
+
+    try:
+        queue.submit(Job(msg.topic, handle_message, client, msg), priority=priority)
+    except QueueFull as e:
+        logging.error(e)
+        publish_error(client, msg.topic, str(e))
+
+
+def handle_message(client, msg):
+    """Does the work for a message; runs on a job queue worker thread."""
+    receipt_printer = get_session()
 
     if msg.topic == get_topic("cash_drawer"):
         logging.info("Opening cashdrawer...")
-        receipt_printer.cashdraw(settings.CASH_DRAWER_PIN)
+        receipt_printer.run(no_sale)
+        return
+
+    if msg.topic == get_topic("no_sale"):
+        receipt_printer.run(no_sale)
+        return
 
     # Commands past here expect a JSON payload:
     try:
@@ -61,46 +147,165 @@ def on_message(client, userdata, msg):
         return
 
     if msg.topic == get_topic("print_cash"):
-        print_receipt(receipt_printer, payload, settings.BOTTOM_TEXT_CASH)
+        print_job(receipt_printer, print_receipt, payload, layouts["cash"])
 
     if msg.topic == get_topic("print_credit"):
-        print_receipt(receipt_printer, payload, settings.BOTTOM_TEXT_CREDIT)
+        print_job(receipt_printer, print_receipt, payload, layouts["credit"])
 
     if msg.topic == get_topic("audit_slip"):
-        print_audit_slip(receipt_printer, payload)
-
-    if msg.topic == get_topic("no_sale"):
-        no_sale(receipt_printer)
+        print_job(receipt_printer, print_audit_slip, payload)
 
     # preview badge command chan
     if msg.topic == get_topic("preview"):
-        badge_printer = printing.Main(local=True)
-
         if settings.THEME == "":
             settings.THEME == "apis"
-        try:
-            badge_printer.nametags(payload.get("badge"), theme=settings.THEME)
-            badge_printer.preview()
-        except Exception as e:
-            logging.error(e)
-            logging.error("Error on preview")
-            logging.error(msg.payload)
+
+        with workspace.job("preview") as job:
+            badge_printer = printing.Main(local=True, job=job)
+            try:
+                if preview_mode() == "image":
+                    publish_preview(client, msg, badge_printer, payload)
+                else:
+                    badge_printer.nametags(
+                        payload.get("badge"),
+                        theme=settings.THEME,
+                        batch=getattr(settings, "BADGE_BATCH_HTML", True),
+                        **getattr(settings, "BADGE_SHARD_SETTINGS", {"shard_size": 25}),
+                    )
+                    # The viewer opens the PDF after the job's files are removed
+                    badge_printer.pdf = job.detach(badge_printer.pdf)
+                    badge_printer.preview()
+            except Exception as e:
+                logging.error(e)
+                logging.error("Error on preview")
+                logging.error(msg.payload)
 
     # print badge command chan
     if msg.topic == get_topic("print"):
-        badge_printer = printing.Main(local=True)
-
         if settings.THEME == "":
             settings.THEME == "apis"
-        try:
-            badge_printer.nametags(payload.get("badges"), theme=settings.THEME)
-            badge_printer.printout()
-        except Exception as e:
-            logging.error(e)
-            logging.error("Error on print")
-            logging.error(msg.payload)
 
-    receipt_printer.close()
+        def progress(printed, total, job_id):
+            publish_progress(client, printed, total, job_id)
+
+        def on_complete(job_id, state, reasons):
+            publish_job_status(client, job_id, state, reasons)
+
+        with workspace.job("print") as job:
+            badge_printer = printing.Main(job=job)
+            try:
+                if getattr(settings, "BADGE_OUTPUT", "pdf") == "zpl":
+                    badges = payload.get("badges")
+                    job_id = print_labels(badge_printer, badges, on_complete)
+                    progress(len(badges), len(badges), job_id)
+                else:
+                    # Each chunk goes to the printer as soon as it has been rendered
+                    badge_printer.print_nametags(
+                        payload.get("badges"),
+                        theme=settings.THEME,
+                        batch=getattr(settings, "BADGE_BATCH_HTML", True),
+                        progress=progress,
+                        on_complete=on_complete,
+                        shard_size=getattr(
+                            settings, "BADGE_SHARD_SETTINGS", {"shard_size": 25}
+                        ).get("shard_size"),
+                        **getattr(
+                            settings, "BADGE_STREAM_SETTINGS", {"chunk_size": 10}
+                        ),
+                    )
+            except Exception as e:
+                logging.error(e)
+                logging.error("Error on print")
+                logging.error(msg.payload)
+
+    logger.debug(f"Printer session stats: {sessions.stats()}")
+
+
+def preview_mode():
+    return getattr(settings, "BADGE_PREVIEW_MODE", "pdf")
+
+
+def publish_preview(client, msg, badge_printer, payload):
+    """
+    Publishes a PNG of the first badge to the payload's reply_to topic, or
+    <base>/preview/image, as {"image": <base64>, "content_type": "image/png"}.
+    """
+    png = badge_printer.preview_image(payload.get("badge"), theme=settings.THEME)
+    reply = {
+        "image": base64.b64encode(png).decode("ascii"),
+        "content_type": "image/png",
+    }
+    client.publish(
+        payload.get("reply_to") or get_topic("preview/image"), json.dumps(reply)
+    )
+
+    # paho stamps messages with time.monotonic() when they arrive
+    latency = (time.monotonic() - msg.timestamp) * 1000
+    preview_times.observe(latency)
+    target = getattr(settings, "BADGE_PREVIEW_TARGET_MS", 300)
+    if latency > target:
+        logger.warning(f"Badge preview took {latency:.0f} ms (target {target} ms)")
+
+
+def print_labels(badge_printer, badges, on_complete):
+    """Prints badges as ZPL labels, to BADGE_ZPL_FILE if set (for testing)."""
+    zpl_file = getattr(settings, "BADGE_ZPL_FILE", None)
+    sink = printing.FileSink(zpl_file) if zpl_file else None
+    return badge_printer.print_labels(
+        badges, theme=settings.THEME, sink=sink, on_complete=on_complete
+    )
+
+
+def start_queues(client):
+    def on_drop(job):
+        publish_error(client, job.name, f"Dropped from full '{job.name}' queue")
+
+    receipt_settings = dict(getattr(settings, "RECEIPT_QUEUE_SETTINGS", {}))
+    # The badge queue's priority jobs are image previews, which render with
+    # wkhtmltoimage and have their own latency target
+    badge_settings = {
+        "priority_target_ms": getattr(settings, "BADGE_PREVIEW_TARGET_MS", 300)
+    }
+    badge_settings.update(getattr(settings, "BADGE_QUEUE_SETTINGS", {}))
+
+    for name, queue_settings in (
+        ("receipt", receipt_settings),
+        ("badge", badge_settings),
+    ):
+        # Jobs are submitted from the MQTT network loop, which must not wait
+        # for a full queue: keepalives would stop and drawer kicks would not
+        # even be received
+        if queue_settings.get("policy") == BLOCK:
+            logger.warning(f"The {name} queue cannot block; rejecting when full")
+            queue_settings["policy"] = REJECT
+        queues[name] = JobQueue(name, on_drop=on_drop, **queue_settings)
+    for queue in queues.values():
+        queue.start()
+
+
+def stop_queues():
+    for queue in queues.values():
+        queue.stop()
+        logger.info(queue.wait_times)
+        logger.info(queue.priority_times)
+    logger.info(preview_times)
+    logger.info(workspace.job_times)
+    logger.info(f"Render workspace: {workspace.stats}")
+
+
+def publish_error(client, topic, error):
+    payload = {"topic": topic, "error": error}
+    client.publish(get_topic("error"), json.dumps(payload))
+
+
+def publish_progress(client, printed, total, job_id=None):
+    payload = {"printed": printed, "total": total, "job": job_id}
+    client.publish(get_topic("print/progress"), json.dumps(payload))
+
+
+def publish_job_status(client, job_id, state, reasons):
+    payload = {"job": job_id, "state": state, "reasons": reasons}
+    client.publish(get_topic("print/status"), json.dumps(payload))
 
 
 def get_topic(command):
@@ -134,39 +339,15 @@ def print_audit_slip(receipt_printer, payload):
     if payload.get("cashdraw", True):
         receipt_printer.cashdraw(settings.CASH_DRAWER_PIN)
 
-    receipt_printer.image("logo.png")
-
-    event = payload.get("event", "APIS")
-
-    builder = ReceiptFormatter(**settings.FORMATTER_SETTINGS)
-    builder.ln()
-    builder.ln()
-    builder.center_text(event)
-    builder.ln()
-    builder.center_text("Cash Audit Report")
-    builder.ln()
-    builder.hr()
-    builder.ln()
-    builder.format_line_item(
-        f"User: {payload.get('user')}", f"Register: {payload.get('terminal')}"
-    )
-    builder.ln()
-    builder.center_text(f"Audit Action: {payload.get('type')}")
-    builder.ln()
-    builder.format_line_item("Amount:", payload.get("amount"))
-    builder.ln()
-    builder.hr()
-    builder.ln()
-    builder.center_text(payload.get("timestamp"))
-
-    print(builder.print())
+    logo.print_logo(receipt_printer)
+
     receipt_printer.set(**settings.PRINTER_SETTINGS)
-    receipt_printer.text(builder.pop())
+    render_body(receipt_printer, layouts["audit_slip"], payload)
 
     receipt_printer.cut()
 
 
-def print_receipt(receipt_printer, payload, bottom_text, cashdraw=True):
+def print_receipt(receipt_printer, payload, layout, cashdraw=True):
     """
     Example payload:
         {
@@ -188,68 +369,46 @@ def print_receipt(receipt_printer, payload, bottom_text, cashdraw=True):
                 "change": "$40.00",
                 "details": "Ref: U4REQT | AID: A0000000031010 | Auth: 025993"
             },
-            "reference": "U4REQT"
+            "reference": "U4REQT",
+            "copies": 2,
+            "copy_footers": ["Customer copy", "Merchant copy"]
         }
+
+    copies and copy_footers are optional.  The receipt is formatted once and
+    the same bytes are sent for each copy, followed by that copy's footer.
+    The cash drawer opens once.
     """
 
     if cashdraw:
         receipt_printer.cashdraw(settings.CASH_DRAWER_PIN)
 
-    receipt_printer.image("logo.png")
-
-    event = payload.get("event", "APIS")
-
-    builder = ReceiptFormatter(**settings.FORMATTER_SETTINGS)
-    builder.ln()
-    builder.center_text(event)
-    builder.ln()
-
-    line_items = payload["line_items"]
-    for line in line_items:
-        builder.format_line_item(line.get("item"), line.get("price"))
-
-    builder.ln()
-
-    donations = payload.get("donations")
-    if donations:
-        org = donations.get("org")
-        if org:
-            builder.format_line_item(f"Donation to {org['name']}", org["price"])
-
-        charities_list = donations.get("charity")
-        logger.debug(f"charity = {charities_list}")
-        for charity in charities_list:
-            builder.format_line_item(f"Donation to {charity['name']}", charity["price"])
+    footers = payload.get("copy_footers") or []
+    copies = max(int(payload.get("copies", 1)), len(footers), 1)
 
-    builder.ln()
-
-    builder.right_text(f"Total Due:  {payload['total']}")
-    builder.ln()
-    builder.hr()
-    builder.ln()
-
-    payment = payload.get("payment")
-
-    if payment:
-        builder.format_line_item(payment["type"], payment["tendered"])
-
-        details = payment.get("details")
-        if details:
-            builder.append(details)
-
-        change = payment.get("change")
-        if change:
-            builder.right_text(f"Change:  {change}")
-
-    builder.ln()
-    builder.hr()
-    builder.ln()
-
-    builder.wrap_center(bottom_text)
+    if copies == 1 and not footers:
+        logo.print_logo(receipt_printer)
+        print_receipt_body(receipt_printer, payload, layout)
+        receipt_printer.cut()
+        return
 
-    print(builder.print())
+    body = buffer_for(receipt_printer)
+    print_receipt_body(body, payload, layout)
+    for copy in range(copies):
+        # The logo is sent per copy so an NV logo upload is not repeated
+        logo.print_logo(receipt_printer)
+        receipt_printer._raw(body.output)
+        receipt_printer.magic.encoding = body.magic.encoding
+        if copy < len(footers) and footers[copy]:
+            builder = ReceiptFormatter(**settings.FORMATTER_SETTINGS)
+            builder.center_text(footers[copy])
+            receipt_printer.text(builder.pop() + "\n")
+        receipt_printer.cut()
+
+
+def print_receipt_body(receipt_printer, payload, layout):
+    """Everything on a receipt from below the logo to the reference barcode."""
     receipt_printer.set(**settings.PRINTER_SETTINGS)
-    receipt_printer.text(builder.pop())
+    render_body(receipt_printer, layout, payload)
 
     reference = payload.get("reference")
     logger.debug(f"reference: {reference}")
@@ -258,13 +417,43 @@ def print_receipt(receipt_printer, payload, bottom_text, cashdraw=True):
         receipt_printer.barcode(reference, "CODE39", align_ct=True)
         receipt_printer.text("\n")
 
-    receipt_printer.cut()
 
+def render_body(receipt_printer, layout, payload):
+    if getattr(settings, "RECEIPT_RENDER_MODE", "buffered") == "streaming":
+        layout.stream(receipt_printer, payload, echo=print)
+    else:
+        print(layout.render(receipt_printer, payload))
 
-def get_printer():
-    escpos_config = Config()
-    receipt_printer = escpos_config.printer()
-    return receipt_printer
+
+def get_session(name="default"):
+    return sessions.get(name)
+
+
+def print_job(session, job, *args):
+    """
+    Prints job(printer, *args) on a printer session according to
+    RECEIPT_RENDER_MODE:
+
+        direct:    every escpos call is its own device write
+        buffered:  render the whole job in memory, then write it in one go
+        pipelined: like buffered, but the write happens on a background
+                   thread while the next job renders
+        streaming: write in small chunks while the job is still formatting,
+                   for long audit reports and large group orders
+    """
+    mode = getattr(settings, "RECEIPT_RENDER_MODE", "buffered")
+    if mode == "direct":
+        session.run(job, *args)
+        return
+    if mode == "streaming":
+        session.stream(job, *args)
+        return
+
+    data = session.render(job, *args)
+    if mode == "pipelined":
+        session.spool(data)
+    else:
+        session.write(data)
 
 
 if __name__ == "__main__":
@@ -291,4 +480,13 @@ if __name__ == "__main__":
     # handles reconnecting.
     # Other loop*() functions are available that give a threaded interface and a
     # manual interface.
-    client.loop_forever()
+    printing.default_backend.start()
+    start_queues(client)
+    try:
+        client.loop_forever()
+    finally:
+        stop_queues()
+        sessions.close()
+        printing.default_backend.close()
+        printing.close_cups()
+        workspace.close()
@@ -0,0 +1,315 @@
+"""Long-lived ESC/POS printer sessions shared between print jobs"""
+
+import logging
+import queue
+import threading
+
+from escpos import exceptions as escpos_exceptions
+from escpos.config import Config
+from escpos.magicencode import MagicEncode
+from escpos.printer import Dummy
+
+logger = logging.getLogger(__name__)
+
+# Errors raised by the escpos USB/serial/network backends when the device has
+# gone away.  pyusb's USBError and pyserial's SerialException are both OSError.
+# Other escpos errors (e.g. BarcodeCodeError) are about the job's content and
+# fail it without reconnecting.
+DEVICE_ERRORS = (OSError, escpos_exceptions.DeviceNotFoundError)
+
+
+def buffer_for(printer):
+    """
+    Returns an escpos Dummy printer that renders commands into memory using
+    printer's capability profile, ready to be sent with a single write.
+    """
+    buffer = Dummy()
+    buffer.profile = printer.profile
+    buffer.magic = MagicEncode(buffer)
+    buffer.session_name = getattr(printer, "session_name", "default")
+    buffer.write_callbacks = []
+    return buffer
+
+
+def after_write(printer, written, discarded):
+    """
+    Calls written() once the output sent to printer so far has reached the
+    device, or discarded() if it never will (the render failed, or the write
+    failed after reconnecting).  For state that depends on what the printer
+    actually received, e.g. logo.NVLogo.  Output sent straight to a device
+    has already been written.
+    """
+    callbacks = getattr(printer, "write_callbacks", None)
+    if callbacks is None:
+        written()
+    else:
+        callbacks.append((written, discarded))
+
+
+def _written(callbacks):
+    for written, discarded in callbacks:
+        written()
+    del callbacks[:]
+
+
+def _discarded(callbacks):
+    for written, discarded in callbacks:
+        discarded()
+    del callbacks[:]
+
+
+class RenderedJob(bytes):
+    """The bytes PrinterSession.render() returns, with their after_write callbacks."""
+
+    write_callbacks = ()
+
+
+class StreamBuffer(Dummy):
+    """
+    A Dummy printer that passes its output on to printer in chunk_size pieces,
+    so a long job starts printing while it is still being rendered.
+    """
+
+    def __init__(self, printer, chunk_size=4096):
+        Dummy.__init__(self)
+        self.profile = printer.profile
+        self.magic = MagicEncode(self)
+        self.session_name = getattr(printer, "session_name", "default")
+        self.printer = printer
+        self.chunk_size = chunk_size
+        self.pending = 0
+        self.write_callbacks = []
+
+    def _raw(self, msg):
+        Dummy._raw(self, msg)
+        self.pending += len(msg)
+        if self.pending >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.printer._raw(self.output)
+            self.clear()
+            self.pending = 0
+        _written(self.write_callbacks)
+        self.printer.magic.encoding = self.magic.encoding
+
+
+class PrinterSession(object):
+    """
+    Keeps one escpos printer handle open across jobs.  The device is opened on
+    first use, reused for every following job and transparently reopened when a
+    job fails because the device was unplugged, power-cycled or dropped off the
+    network.
+    """
+
+    def __init__(self, name="default", config_path=None, retries=1, spool_depth=2):
+        self.name = name
+        self.config_path = config_path
+        self.retries = retries
+        self.printer = None
+        self.lock = threading.RLock()
+        self.stats = {
+            "opens": 0,
+            "reuses": 0,
+            "reconnects": 0,
+            "errors": 0,
+            "writes": 0,
+            "bytes": 0,
+        }
+
+        self.spool_depth = spool_depth
+        self.spool_queue = None
+        self.spooler = None
+
+    def open(self):
+        """Builds the printer from escpos-config.yaml and opens the device."""
+        with self.lock:
+            if self.printer is not None:
+                return self.printer
+
+            logger.info(f"Opening receipt printer '{self.name}'")
+            escpos_config = Config()
+            escpos_config.load(self.config_path)
+            printer = escpos_config.printer()
+            printer.open()
+            # Lets per-device state (e.g. logo.NVLogo) tell printers apart
+            printer.session_name = self.name
+            self.printer = printer
+            self.stats["opens"] += 1
+            return printer
+
+    def close(self):
+        """Writes out anything still spooled, then closes the device."""
+        self._stop_spooler()
+        self._close_device()
+
+    def _close_device(self):
+        with self.lock:
+            if self.printer is None:
+                return
+            logger.info(f"Closing receipt printer '{self.name}'")
+            try:
+                self.printer.close()
+            except DEVICE_ERRORS as e:
+                logger.warning(f"Error closing printer '{self.name}': {e}")
+            self.printer = None
+
+    def run(self, job, *args, **kwargs):
+        """
+        Calls job(printer, *args, **kwargs) with the open printer, holding the
+        session lock for the duration.  If the device fails the handle is
+        discarded, reopened and the job retried up to self.retries times.
+        """
+        with self.lock:
+            attempt = 0
+            while True:
+                reused = self.printer is not None
+                try:
+                    printer = self.open()
+                    if reused:
+                        self.stats["reuses"] += 1
+                    return job(printer, *args, **kwargs)
+                except DEVICE_ERRORS as e:
+                    self.stats["errors"] += 1
+                    logger.error(f"Printer '{self.name}' failed: {e}")
+                    self._close_device()
+                    if attempt >= self.retries:
+                        raise
+                    attempt += 1
+                    self.stats["reconnects"] += 1
+                    logger.info(
+                        f"Reconnecting to printer '{self.name}' (attempt {attempt})"
+                    )
+
+    def render(self, job, *args, **kwargs):
+        """
+        Calls job(buffer, *args, **kwargs) against an in-memory printer with
+        this device's profile and returns the rendered ESC/POS bytes.  No
+        device I/O happens until the bytes are passed to write() or spool().
+        """
+        buffer = buffer_for(self.open())
+        try:
+            job(buffer, *args, **kwargs)
+        except Exception:
+            _discarded(buffer.write_callbacks)
+            raise
+        data = RenderedJob(buffer.output)
+        data.write_callbacks = buffer.write_callbacks
+        return data
+
+    def write(self, data):
+        """Sends a rendered buffer to the device in one write."""
+        callbacks = getattr(data, "write_callbacks", [])
+        try:
+            self.run(self._write, data)
+        except Exception:
+            _discarded(callbacks)
+            raise
+        _written(callbacks)
+
+    def _write(self, printer, data):
+        printer._raw(data)
+        # The buffer switched code pages behind the device encoder's back, so
+        # make it emit a code page select before the next direct text() call.
+        printer.magic.encoding = None
+        self.stats["writes"] += 1
+        self.stats["bytes"] += len(data)
+
+    def stream(self, job, *args, chunk_size=4096, **kwargs):
+        """
+        Calls job(buffer, *args, **kwargs) with a StreamBuffer in front of the
+        device: output is written every chunk_size bytes while the job runs.
+        """
+
+        def streamed(printer):
+            buffer = StreamBuffer(printer, chunk_size)
+            try:
+                job(buffer, *args, **kwargs)
+                buffer.flush()
+            except Exception:
+                _discarded(buffer.write_callbacks)
+                raise
+
+        self.run(streamed)
+
+    def spool(self, data):
+        """
+        Queues a rendered buffer for a background writer thread and returns
+        immediately, so the caller can render the next job while this one is
+        still draining to the device.  Blocks once spool_depth buffers are
+        waiting.
+        """
+        with self.lock:
+            if self.spooler is None:
+                self.spool_queue = queue.Queue(self.spool_depth)
+                self.spooler = threading.Thread(
+                    target=self._spool_worker,
+                    args=(self.spool_queue,),
+                    name=f"{self.name}-spooler",
+                    daemon=True,
+                )
+                self.spooler.start()
+            spool_queue = self.spool_queue
+        spool_queue.put(data)
+
+    def drain(self):
+        """Waits until every spooled buffer has been written."""
+        if self.spool_queue is not None:
+            self.spool_queue.join()
+
+    def _spool_worker(self, spool_queue):
+        while True:
+            data = spool_queue.get()
+            try:
+                if data is None:
+                    return
+                self.write(data)
+            except DEVICE_ERRORS as e:
+                logger.error(
+                    f"Dropped {len(data)} spooled bytes for '{self.name}': {e}"
+                )
+            finally:
+                spool_queue.task_done()
+
+    def _stop_spooler(self):
+        with self.lock:
+            spooler, spool_queue = self.spooler, self.spool_queue
+            self.spooler = self.spool_queue = None
+        if spooler is not None:
+            spool_queue.put(None)
+            spooler.join()
+
+
+class SessionManager(object):
+    """Hands out one PrinterSession per configured device name."""
+
+    def __init__(self, configs=None):
+        """
+        Accepts a dictionary of device name to escpos YAML config path.  A path
+        of None uses the python-escpos default config location.
+        """
+        if not configs:
+            configs = {"default": None}
+        self.configs = configs
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def get(self, name="default"):
+        with self.lock:
+            session = self.sessions.get(name)
+            if session is None:
+                if name not in self.configs:
+                    raise KeyError(f"No receipt printer configured named '{name}'")
+                session = PrinterSession(name, self.configs[name])
+                self.sessions[name] = session
+            return session
+
+    def stats(self):
+        with self.lock:
+            return {name: dict(s.stats) for name, s in self.sessions.items()}
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
@@ -1,38 +1,59 @@
 """Handles generation of HTML for nametags, saving/reading printer config, etc"""
 
+import collections
 import datetime
+import hashlib
+import json
 import logging
 import os
+import pathlib
 import platform
+import queue
 import re
+import select
+import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from configobj import ConfigObj
 
+import render_service
+
 PRINT_MODE = "pdf"
 
 # Platforms using the CUPS printing system (UNIX):
 unix = ["Linux", "linux2", "Darwin"]
 WKHTMLTOPDF = "/usr/local/bin/wkhtmltopdf"  # path to wkhtmltopdf binary
+WKHTMLTOIMAGE = "/usr/local/bin/wkhtmltoimage"  # used for preview images
+PREVIEW_DPI = 96  # screen resolution of preview images
 
 SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
 NAMETAGS = os.path.join(
     SCRIPT_PATH, "resources", "nametag"
 )  # path where html can be found.
-LPR = "/usr/bin/lpr"  # path to LPR program (CUPS/Unix only).
+PDFUNITE = "/usr/bin/pdfunite"  # used to merge PDFs when pypdf is not installed
+INVENTORY_TTL = 30  # seconds between refreshes of the CUPS printer list
+JOB_POLL_INTERVAL = 1  # seconds between checks on submitted CUPS jobs
+JOB_CHECK_RETRIES = 5  # failed checks before a watched job is reported unknown
+THEME_VERSION_TTL = 5  # seconds a theme's file listing is trusted for
+RENDER_SERVICE = os.path.join(SCRIPT_PATH, "render_service.py")
 
 
 class Printer:
-    def __init__(self, local=False):
+    def __init__(self, local=False, backend=None):
         self.log = logging.getLogger(__name__)
+        self.backend = backend
+        self.temp_dir = None  # where output files go; None for the system default
         if local:
             self.con = _DummyPrinter()
         else:
             if platform.system() in unix:
                 self.log.info("System is type UNIX. Using CUPS.")
-                self.con = _CUPS()
+                self.con = _CUPS.shared()
             elif platform.system() == "win32":
                 self.log.info("System is type WIN32. Using GDI.")
                 # TODO implement win32 printing code
@@ -99,12 +120,14 @@ class Printer:
 
     def writePdf(self, args, html, copies=1, collate=True):
         """
-        Calls wkhtmltopdf and generates a pdf. Accepts args as a list, path
-        to html file, and returns path to temporary file.  Temp file
+        Renders html to a pdf with the render backend (wkhtmltopdf unless
+        another was set).  Accepts args as a list, path to html file (or a
+        list of them), and returns path to temporary file.  Temp file
         should be unlinked when no longer needed.
         Also accepts copies=1, collate=True
         """
         # Build arguments
+        args = list(args)
         if copies < 0:
             copies = 1
         if copies != 1:
@@ -113,30 +136,66 @@ class Printer:
         if collate:
             args.append("--collate")
 
-        if isinstance(html, list):
-            args += html
-        else:
-            args.append(html)
+        if not isinstance(html, list):
+            html = [html]
 
         # create temp file to write to
-        out = tempfile.NamedTemporaryFile(delete=False, prefix="apis", suffix=".pdf")
+        out = tempfile.NamedTemporaryFile(
+            delete=False, prefix="apis", suffix=".pdf", dir=self.temp_dir
+        )
         out.close()
-        args.append(out.name)  # append output file name
-
-        self.log.debug("Calling {0} with arguments <".format(WKHTMLTOPDF))
-        self.log.debug("{0} >".format(" ".join(args)))
-
-        if args[0] != WKHTMLTOPDF:
-            args.insert(0, WKHTMLTOPDF)  # prepend program name
 
-        ret = subprocess.check_call(args)
-        if ret != 0:
-            self.log.error("Called process error:")
-            self.log.error("Program returned exit code {0}".format(ret))
-            return 0
+        backend = self.backend or default_backend
+        try:
+            backend.render(args, html, out.name)
+        except Exception:
+            os.unlink(out.name)
+            raise
         self.log.debug("Generated pdf {0}".format(out.name))
         return out.name
 
+    def buildImageArguments(self, args, dpi=PREVIEW_DPI):
+        """
+        Returns wkhtmltoimage arguments for a screen resolution PNG of a
+        badge, from the wkhtmltopdf args built by buildArguments: the page
+        size becomes the image size in pixels at dpi, and zoom is kept.
+        """
+        # Maps each option to the argument that follows it
+        options = dict(zip(args, args[1:]))
+        image_args = ["--format", "png", "--quality", "30"]
+        if "--enable-local-file-access" in args:
+            image_args.append("--enable-local-file-access")
+        if "--zoom" in options:
+            image_args += ["--zoom", str(options["--zoom"])]
+
+        # Like wkhtmltopdf with a custom page size, --orientation is ignored
+        width = _pixels(options.get("--page-width"), dpi)
+        height = _pixels(options.get("--page-height"), dpi)
+        if width:
+            image_args += ["--width", str(width)]
+        if height:
+            image_args += ["--height", str(height)]
+        return image_args
+
+    def writePng(self, args, html):
+        """
+        Calls wkhtmltoimage to render html to a PNG at screen resolution.
+        Accepts wkhtmltopdf args, as for writePdf, and returns the path to a
+        temporary file that should be unlinked when no longer needed.
+        """
+        out = tempfile.NamedTemporaryFile(
+            delete=False, prefix="apis", suffix=".png", dir=self.temp_dir
+        )
+        out.close()
+        command = [WKHTMLTOIMAGE] + self.buildImageArguments(args) + [html, out.name]
+        self.log.debug("Calling {0}".format(" ".join(command)))
+        try:
+            subprocess.check_call(command)
+        except Exception:
+            os.unlink(out.name)
+            raise
+        return out.name
+
     def preview(self, fileName):
         """Opens a file using the default application. (Print preview)"""
         if os.name == "posix":
@@ -189,9 +248,17 @@ class Printer:
             os.startfile(fileName)
             return 0
 
-    def printout(self, filename, printer=None, orientation=None):
-        if os.name == "posix" or os.name == "mac":  # use CUPS/lpr
-            self.con.printout(filename, printer, orientation)
+    def printout(
+        self, filename, printer=None, orientation=None, on_complete=None, raw=False
+    ):
+        """
+        Submits filename to the printer and returns the job id.  See
+        _CUPS.printout for on_complete and raw.
+        """
+        if os.name == "posix" or os.name == "mac":  # use CUPS
+            return self.con.printout(
+                filename, printer, orientation, on_complete=on_complete, raw=raw
+            )
 
     # ---- printing proxy methods -----
 
@@ -206,104 +273,653 @@ class Printer:
         return self.con.getPrinters()
 
 
-class Nametag:
-    def __init__(self, barcode=False):
-        """
-        Format nametags with data using available HTML templates.  Will
-        fetch barcode encoding options from global config; otherwise accepts
-        barcode=False as the initialization argument.
-        """
-        # TODO: source config options for barcode, etc. from global config.
-        self.barcodeEnable = barcode
+LENGTH_RE = re.compile(r"^\s*([0-9.]+)\s*(mm|cm|in|px)?\s*$", re.IGNORECASE)
+UNITS_PER_INCH = {"mm": 25.4, "cm": 2.54, "in": 1.0}
+
+
+def _pixels(length, dpi):
+    """Converts a wkhtmltopdf length (millimetres if no unit) to pixels."""
+    match = LENGTH_RE.match(str(length or ""))
+    if match is None:
+        return None
+    value, unit = float(match.group(1)), (match.group(2) or "mm").lower()
+    if unit == "px":
+        return int(round(value))
+    return int(round(value * dpi / UNITS_PER_INCH[unit]))
+
+
+class WkhtmltopdfBackend:
+    """Renders each document with a new wkhtmltopdf process."""
+
+    def __init__(self, program=None):
         self.log = logging.getLogger(__name__)
+        self.program = program
+
+    def render(self, args, html_files, output):
+        """Writes html_files to the pdf output using wkhtmltopdf args."""
+        program = self.program or WKHTMLTOPDF
+        command = [program] + [str(arg) for arg in args] + html_files + [output]
+        self.log.debug("Calling {0} with arguments <".format(program))
+        self.log.debug("{0} >".format(" ".join(command[1:])))
+        subprocess.check_call(command)
+
+    def start(self):
+        pass
 
-        # Setup and compile regex replacements:
-        self.date_re = re.compile(r"%DATE%", re.IGNORECASE)  # date
-        self.time_re = re.compile(r"%TIME%", re.IGNORECASE)  # time
-        self.room_re = re.compile(r"%ROOM%", re.IGNORECASE)  # room
-        self.first_re = re.compile(r"%FIRST%", re.IGNORECASE)  # name
-        self.name_re = re.compile(r"%NAME%", re.IGNORECASE)  # name
-        self.last_re = re.compile(r"%LAST%", re.IGNORECASE)  # surname
-        self.medical_re = re.compile(r"%MEDICAL%", re.IGNORECASE)  # medical
-        self.code_re = re.compile(r"%CODE%", re.IGNORECASE)  # paging code
-        self.secure_re = re.compile(r"%S%", re.IGNORECASE)  # security code
-        self.title_re = re.compile(r"%TITLE%", re.IGNORECASE)  # security code
-        self.number_re = re.compile(r"%NUMBER%", re.IGNORECASE)  # security code
-        self.level_re = re.compile(r"%LEVEL%", re.IGNORECASE)  # security code
-        self.age_re = re.compile(r"%AGE%", re.IGNORECASE)  # age
-
-        self.medicalIcon_re = re.compile(
-            r"window\.onload\s=\shide\('medical'\)\;", re.IGNORECASE
+    def close(self):
+        pass
+
+
+class RenderError(Exception):
+    pass
+
+
+class _RenderProcess:
+    """One render_service.py child and the pipe to it."""
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.process = subprocess.Popen(
+            [sys.executable, RENDER_SERVICE],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=SCRIPT_PATH,
         )
-        self.volunteerIcon_re = re.compile(
-            r"window\.onload\s=\shide\('volunteer'\)\;", re.IGNORECASE
+        ok, detail = self._receive()
+        if not ok:
+            self.close()
+            raise RenderError(detail)
+        self.version = detail
+
+    def _receive(self):
+        ready, _, _ = select.select([self.process.stdout], [], [], self.timeout)
+        if not ready:
+            self.process.kill()
+            raise RenderError(
+                "Renderer did not answer within {0}s".format(self.timeout)
+            )
+        try:
+            return render_service.recv_message(self.process.stdout)
+        except EOFError:
+            raise RenderError(
+                "Renderer exited with code {0}".format(self.process.wait())
+            )
+
+    def render(self, args, html_files):
+        try:
+            render_service.send_message(self.process.stdin, (args, html_files))
+        except OSError as e:
+            raise RenderError("Renderer pipe closed: {0}".format(e))
+        return self._receive()
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def close(self):
+        if self.alive():
+            try:
+                render_service.send_message(self.process.stdin, None)
+                self.process.stdin.close()
+                self.process.wait(5)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+
+
+class PersistentBackend:
+    """
+    Keeps up to `processes` render_service.py children warm and hands each
+    document to an idle one over its pipe, so the HTML engine, fonts and
+    stylesheets are loaded once rather than per badge.  A child that crashes
+    or hangs is replaced on the next job.  If the renderer cannot be started
+    (e.g. WeasyPrint is not installed) or fails on a document, the document
+    is rendered by the fallback backend instead.
+    """
+
+    def __init__(self, processes=1, timeout=60, fallback=None):
+        self.log = logging.getLogger(__name__)
+        self.processes = processes
+        self.timeout = timeout
+        self.fallback = fallback or WkhtmltopdfBackend()
+        self.lock = threading.Lock()
+        self.available = True
+        self.stats = {"renders": 0, "restarts": 0, "fallbacks": 0}
+        self.idle = queue.Queue()
+        self._fill()
+
+    def _fill(self):
+        # None marks a pool slot whose child has not been started yet
+        for i in range(self.processes):
+            self.idle.put(None)
+
+    def start(self):
+        """Starts every child now rather than on the first jobs."""
+        workers = [self._acquire() for i in range(self.processes)]
+        for worker in workers:
+            if worker is not None:
+                self.idle.put(worker)
+
+    def _acquire(self):
+        """
+        Waits for an idle child, starting or replacing it if needed.  Returns
+        None if the renderer is unavailable.
+        """
+        if not self.available:
+            return None
+        worker = self.idle.get()
+        if worker is not None and worker.alive():
+            return worker
+        if worker is not None:
+            with self.lock:
+                self.stats["restarts"] += 1
+
+        try:
+            worker = _RenderProcess(self.timeout)
+        except (OSError, RenderError) as e:
+            self.available = False
+            self.idle.put(None)
+            self.log.error(
+                "Unable to start persistent renderer, using {0}: {1}".format(
+                    type(self.fallback).__name__, e
+                )
+            )
+            return None
+        self.log.info(
+            "Started persistent renderer (WeasyPrint {0})".format(worker.version)
         )
+        return worker
+
+    def render(self, args, html_files, output):
+        worker = self._acquire()
+        if worker is not None:
+            try:
+                ok, result = worker.render(args, html_files)
+            except RenderError as e:
+                ok, result = False, str(e)
+            finally:
+                self.idle.put(worker)
+
+            if ok:
+                with open(output, "wb") as f:
+                    f.write(result)
+                with self.lock:
+                    self.stats["renders"] += 1
+                return
+            self.log.error("Persistent renderer failed: {0}".format(result))
+
+        with self.lock:
+            self.stats["fallbacks"] += 1
+        self.fallback.render(args, html_files, output)
+
+    def close(self):
+        """Waits for running jobs, then stops the children."""
+        for i in range(self.processes):
+            worker = self.idle.get()
+            if worker is not None:
+                worker.close()
+        self._fill()
+        self.fallback.close()
+
+
+# Used by every Printer not given a backend; replace to change how badges render
+default_backend = WkhtmltopdfBackend()
+
+
+def close_cups():
+    """Stops the shared CUPS connection's background threads."""
+    _CUPS.close_shared()
+
+
+def can_merge_pdfs():
+    """Returns True if merge_pdfs() has pypdf or pdfunite to work with."""
+    try:
+        import pypdf  # noqa: F401
+    except ImportError:
+        return os.path.isfile(PDFUNITE)
+    return True
+
+
+def merge_pdfs(pdfs, output):
+    """Concatenates the pdf files in pdfs, in order, into output."""
+    try:
+        from pypdf import PdfWriter
+    except ImportError:
+        subprocess.check_call([PDFUNITE] + pdfs + [output])
+        return
+
+    writer = PdfWriter()
+    for pdf in pdfs:
+        writer.append(pdf)
+    with open(output, "wb") as f:
+        writer.write(f)
+
+
+# Fields substituted into nametag HTML by Nametag.nametag
+PLACEHOLDER_RE = re.compile(r"%(DATE|TIME|NAME|LEVEL|TITLE|NUMBER|AGE)%", re.IGNORECASE)
+
+
+class CompiledTemplate:
+    """
+    Nametag HTML pre-split into literal chunks and placeholder slots, so a
+    badge is rendered with a single join.  Substituted values are never
+    scanned again, so a name containing e.g. %LEVEL% is printed as-is.
+    """
+
+    def __init__(self, html):
+        # split() with a capturing group alternates literal, field, literal...
+        self.parts = PLACEHOLDER_RE.split(html)
+        self.slots = [(i, self.parts[i].lower()) for i in range(1, len(self.parts), 2)]
+        self.fields = set(field for i, field in self.slots)
+
+    def render(self, values):
+        """Fills the slots from a dictionary of lower case field names."""
+        parts = list(self.parts)
+        for i, field in self.slots:
+            parts[i] = values[field]
+        return "".join(parts)
+
+
+# Opening <head> tag, after which Main._with_base inserts a <base> element
+HEAD_RE = re.compile(r"<head(\s[^>]*)?>", re.IGNORECASE)
+
+# Splits a nametag document around the contents of its <body>
+BODY_RE = re.compile(r"(<body[^>]*>)(.*)(</body>)", re.IGNORECASE | re.DOTALL)
+
+# Starts every badge of a combined batch document on a new page, with
+# absolutely positioned elements placed relative to their own badge
+BATCH_CSS = (
+    "<style>.apis-badge { position: relative; page-break-after: always; }\n"
+    ".apis-badge:last-child { page-break-after: auto; }</style>\n"
+)
+
+SCRIPT_RE = re.compile(r"<script\b", re.IGNORECASE)
+
+# Runs the theme's scripts once per badge of a combined batch document.  Ids
+# repeat once per badge, so getElementById() looks inside the badge being
+# parsed, or, while window.onload (e.g. hide('medical')) is called for each
+# badge in turn, inside that badge.
+BATCH_SCRIPT = """<script>
+(function () {
+  var byId = document.getElementById;
+  var current = null;
+  function badges() {
+    return document.querySelectorAll(".apis-badge");
+  }
+  document.getElementById = function (id) {
+    var all = badges();
+    var badge = current || all[all.length - 1];
+    if (!badge) {
+      return byId.call(document, id);
+    }
+    var nodes = badge.getElementsByTagName("*");
+    for (var i = 0; i < nodes.length; i++) {
+      if (nodes[i].id === id) {
+        return nodes[i];
+      }
+    }
+    return null;
+  };
+  document.addEventListener("DOMContentLoaded", function () {
+    var onload = window.onload;
+    if (typeof onload !== "function") {
+      return;
+    }
+    window.onload = function (event) {
+      var all = badges();
+      for (var i = 0; i < all.length; i++) {
+        current = all[i];
+        onload.call(window, event);
+      }
+      current = null;
+    };
+  });
+})();
+</script>
+"""
+
+
+# ZPL ^FH escapes for characters that would otherwise start a command
+ZPL_ESCAPES = {"_": "_5F", "^": "_5E", "~": "_7E"}
+ZPL_ALIGN = {"left": "L", "center": "C", "right": "R", "justify": "J"}
+
+
+class LabelLayout:
+    """
+    A badge layout for label printers that speak ZPL, read from the [layout]
+    section of a theme's .conf file.  Sizes and positions are in
+    millimetres; text uses the same %NAME%-style placeholders as
+    default.html:
+
+        [layout]
+        width = 89
+        height = 28
+        dpi = 300
+            [[name]]
+            text = %NAME%
+            x = 2
+            y = 4
+            height = 8      # character height
+            align = center  # within width (default: the rest of the label)
+            lines = 2       # wrap onto up to this many lines
+            [[rule]]
+            type = box
+            x = 2
+            y = 14
+            width = 85
+            height = 0.3    # boxes are filled unless a thickness is given
+
+    The ZPL for each element is built once; a badge only fills in its field
+    data.
+    """
+
+    def __init__(self, section):
+        self.dpi = float(section.get("dpi", 203))
+        self.width = self.dots(section.get("width", 89))
+        self.height = self.dots(section.get("height", 28))
+        self.header = "^XA^CI28^PW{0}^LL{1}".format(self.width, self.height)
+        self.elements = []  # (ZPL prefix, CompiledTemplate or None)
+        self.fields = set()
+
+        for name in section.sections:
+            element = section[name]
+            x = self.dots(element.get("x", 0))
+            y = self.dots(element.get("y", 0))
+            if element.get("type", "text") == "box":
+                width = self.dots(element.get("width", 0))
+                height = self.dots(element.get("height", 0))
+                if "thickness" in element:
+                    thickness = self.dots(element["thickness"])
+                else:  # filled
+                    thickness = min(width, height)
+                thickness = max(1, thickness)
+                self.elements.append(
+                    (
+                        "^FO{0},{1}^GB{2},{3},{4}^FS".format(
+                            x, y, width, height, thickness
+                        ),
+                        None,
+                    )
+                )
+                continue
+
+            template = CompiledTemplate(element["text"])
+            self.fields |= template.fields
+            height = self.dots(element.get("height", 5))
+            width = self.dots(element["width"]) if "width" in element else None
+            prefix = "^FO{0},{1}^A{2}N,{3},{3}^FB{4},{5},0,{6},0^FH_^FD".format(
+                x,
+                y,
+                element.get("font", "0"),
+                height,
+                width or self.width - x,
+                int(element.get("lines", 1)),
+                ZPL_ALIGN[element.get("align", "left").lower()],
+            )
+            self.elements.append((prefix, template))
+
+    def dots(self, mm):
+        return int(round(float(mm) * self.dpi / 25.4))
+
+    @staticmethod
+    def escape(text):
+        return "".join(ZPL_ESCAPES.get(c, c) for c in text)
+
+    def label(self, values):
+        """Returns the ZPL for one badge, given its placeholder values."""
+        parts = [self.header]
+        for prefix, template in self.elements:
+            parts.append(prefix)
+            if template is not None:
+                parts.append(self.escape(template.render(values)))
+                parts.append("^FS")
+        parts.append("^XZ\n")
+        return "".join(parts)
+
+
+class Theme:
+    """A nametag theme's HTML, configuration and wkhtmltopdf arguments."""
+
+    def __init__(self, name, path, conf_file, stamp):
+        self.log = logging.getLogger(__name__)
+        self.name = name
+        self.path = path
+        self.conf_file = conf_file
+        self.stamp = stamp
+        self._config = None
+        self._arguments = {}
+        self._template = None
+        self._batch_templates = None
+        self._digest = None
+        self._version = None  # (directory mtime, time.monotonic(), hex digest)
+        self._layout = None
+
+        html_file = os.path.join(path, "default.html")
+        self.log.debug("Reading {0}...".format(html_file))
+        with open(html_file) as f:
+            self.html = f.read()
+        if len(self.html) == 0:  # template file is empty: use default instead.
+            self.log.warn("HTML template file {0} is blank.".format(html_file))
+
+    @property
+    def version(self):
+        """
+        Hash of the theme's HTML, configuration and the names, sizes and
+        mtimes of its other files (stylesheets, images, fonts).  Editing one
+        of those files in place does not make ThemeRegistry reload the theme,
+        so the files are checked again when the theme directory's mtime
+        changes (a file added, removed or replaced) or every
+        THEME_VERSION_TTL seconds.
+        """
+        stamp = ThemeRegistry._mtime(self.path)
+        now = time.monotonic()
+        cached = self._version
+        if (
+            cached is not None
+            and cached[0] == stamp
+            and now - cached[1] < THEME_VERSION_TTL
+        ):
+            return cached[2]
+
+        if self._digest is None:
+            digest = hashlib.sha256(self.html.encode("utf-8"))
+            with open(self.conf_file, "rb") as f:
+                digest.update(f.read())
+            self._digest = digest
+        digest = self._digest.copy()
+        for directory, dirs, names in sorted(os.walk(self.path)):
+            for name in sorted(names):
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                digest.update(
+                    "{0}:{1}:{2}\n".format(
+                        os.path.relpath(path, self.path), st.st_size, st.st_mtime_ns
+                    ).encode("utf-8")
+                )
+        version = digest.hexdigest()
+        self._version = (stamp, now, version)
+        return version
+
+    @property
+    def template(self):
+        """The HTML compiled for substitution, with the barcode blanked out."""
+        if self._template is None:
+            # replace barcode image with white.gif
+            self._template = CompiledTemplate(
+                self.html.replace("default-secure.png", "white.gif")
+            )
+        return self._template
+
+    @property
+    def batch_templates(self):
+        """
+        The template split into (head, body, tail) CompiledTemplates for
+        combining several badges into one document, or None if the HTML has
+        no <body> element.  Themes with scripts also get BATCH_SCRIPT, which
+        runs them against every badge.
+        """
+        if self._batch_templates is None:
+            html = self.html.replace("default-secure.png", "white.gif")
+            match = BODY_RE.search(html)
+            if match is None:
+                self._batch_templates = False
+            else:
+                script = BATCH_SCRIPT if SCRIPT_RE.search(html) else ""
+                self._batch_templates = (
+                    CompiledTemplate(html[: match.end(1)] + BATCH_CSS + script),
+                    CompiledTemplate(match.group(2)),
+                    CompiledTemplate(html[match.start(3) :]),
+                )
+        return self._batch_templates or None
+
+    @property
+    def config(self):
+        """Parsed .conf file.  Raises KeyError if it has no [default] section."""
+        if self._config is None:
+            self.log.info(
+                "Reading template configuration from '{0}'".format(self.conf_file)
+            )
+            config = ConfigObj(self.conf_file)
+            if "default" not in config:
+                self.log.error(
+                    "{0} contains no [default] section and is invalid.".format(
+                        self.conf_file
+                    )
+                )
+                raise KeyError(
+                    "{0} contains no [default] section and is invalid.".format(
+                        self.conf_file
+                    )
+                )
+            self._config = config
+        return self._config
+
+    @property
+    def layout(self):
+        """The LabelLayout from the .conf [layout] section, or None."""
+        if self._layout is None:
+            section = self.config.get("layout")
+            self._layout = LabelLayout(section) if section is not None else False
+        return self._layout or None
+
+    def arguments(self, printer, section="default"):
+        """
+        Returns a copy of the wkhtmltopdf arguments for a section, built with
+        printer.buildArguments the first time they are asked for.
+        """
+        if section not in self._arguments:
+            self._arguments[section] = printer.buildArguments(self.config, section)
+        return list(self._arguments[section])
+
 
-    def list_templates(self, directory=NAMETAGS):
-        """Returns a list of the installed nametag themes"""
-        # TODO: add more stringent validation against config and html.
-        directory = os.path.abspath(directory)
-        self.log.debug("Searching for html templates in {0}".format(directory))
+class ThemeRegistry:
+    """
+    Loads each nametag theme once and serves it from memory.  A theme is
+    reloaded only when the mtime of its default.html or .conf file changes,
+    and the theme list is rescanned only when the nametag directory's mtime
+    changes.
+    """
+
+    def __init__(self, directory=NAMETAGS):
+        self.log = logging.getLogger(__name__)
+        self.directory = os.path.abspath(directory)
+        self.lock = threading.Lock()
+        self.themes = {}
+        self.listing = None
+        self.listing_stamp = None
+        self.stats = {"hits": 0, "loads": 0, "rescans": 0}
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def list_templates(self):
+        """Returns a sorted list of the installed nametag themes."""
+        with self.lock:
+            stamp = self._mtime(self.directory)
+            if self.listing is None or stamp != self.listing_stamp:
+                self.stats["rescans"] += 1
+                self.listing = self._scan()
+                self.listing_stamp = stamp
+            return list(self.listing)
+
+    def _scan(self):
+        """Returns the sorted names of directories that contain a .conf file."""
+        self.log.debug("Searching for html templates in {0}".format(self.directory))
         try:
-            resource = os.listdir(directory)
+            resource = os.listdir(self.directory)
         except OSError as e:
             self.log.error("({0})".format(e))
             return []
 
-        themes = []
-        # Remove any files from themes[] that are not directories:
-        for i in resource:
-            if os.path.isdir(os.path.join(directory, i)):
-                themes.append(i)
-
         valid = []
-        # Check that each folder has the corresponding .conf file:
-        for i in themes:
-            if os.path.isfile(self._get_template_file(i)):
+        for i in resource:
+            if os.path.isfile(os.path.join(self.directory, i, "{0}.conf".format(i))):
                 valid.append(i)
-
         valid.sort()
-        del resource, themes
         self.log.debug("Found templates {0}".format(valid))
         return valid
 
-    def _get_template_file(self, theme, directory=NAMETAGS):
+    def get(self, name):
+        path = os.path.join(self.directory, name)
+        conf_file = os.path.join(path, "{0}.conf".format(name))
+        stamp = (
+            self._mtime(os.path.join(path, "default.html")),
+            self._mtime(conf_file),
+        )
+        with self.lock:
+            theme = self.themes.get(name)
+            if theme is not None and theme.stamp == stamp:
+                self.stats["hits"] += 1
+                return theme
+
+            self.log.debug("Loading theme {0} from {1}".format(name, path))
+            theme = Theme(name, path, conf_file, stamp)
+            self.themes[name] = theme
+            self.stats["loads"] += 1
+            return theme
+
+
+class Nametag:
+    medicalIcon_re = re.compile(
+        r"window\.onload\s=\shide\('medical'\)\;", re.IGNORECASE
+    )
+    volunteerIcon_re = re.compile(
+        r"window\.onload\s=\shide\('volunteer'\)\;", re.IGNORECASE
+    )
+
+    def __init__(self, barcode=False, themes=None):
         """
-        Returns full path to .conf file for an installed template pack and
-        check it exists.
+        Format nametags with data using available HTML templates.  Will
+        fetch barcode encoding options from global config; otherwise accepts
+        barcode=False as the initialization argument.  Themes are read through
+        the shared ThemeRegistry unless another one is passed as themes.
         """
-        directory = os.path.abspath(directory)
-        path = os.path.join(directory, theme, "{0}.conf".format(theme))
-        # TODO: more stringent checks (is there a matching HTML file?)
-        if os.path.isfile(path):
-            return path
-        else:
-            self.log.warning("{0} does not exist or is not file.".format(path))
+        # TODO: source config options for barcode, etc. from global config.
+        self.barcodeEnable = barcode
+        self.themes = themes
+        self.log = logging.getLogger(__name__)
 
     def _get_template_path(self, theme, directory=NAMETAGS):
         """Returns absolute path only of template pack"""
         return os.path.join(directory, theme)
 
+    def _get_themes(self):
+        if self.themes is None:
+            self.themes = registry
+        return self.themes
+
     def read_config(self, theme):
         """
         Reads the configuration for a specified template pack. Returns
         dictionary.
         """
-        inifile = self._get_template_file(theme)
-        self.log.info("Reading template configuration from '{0}'".format(inifile))
-        config = ConfigObj(inifile)
-        try:  # check for default section
-            default = config["default"]
-        except KeyError as e:
-            self.log.error(e)
-            self.log.error(
-                "{0} contains no [default] section and is invalid.".format(inifile)
-            )
-            raise KeyError(
-                "{0} contains no [default] section and is invalid.".format(inifile)
-            )
-        del default
-        return config
+        return self._get_themes().get(theme).config
 
     def nametag(
         self,
@@ -318,56 +934,75 @@ class Nametag:
         # def nametag(self, template='default', room='', first='', last='', medical='',
         #            code='', secure='', barcode=True):
 
-        # Check that theme specified is valid:
-        if template != "default":
-            themes = self.list_templates()
-            if template not in themes:
-                self.log.error("Bad theme specified.  Using default instead.")
-                template = "default"
-        # Read in the HTML from template.
-        try:
-            directory = self._get_template_path(template)
-        except KeyError:
-            self.log.error(
-                "Unable to process template '{0}'. Aborting.".format(template)
-            )
-            return None
-
-        # read in the HTML
+        # Read in the HTML from template (cached by the theme registry).
         self.log.debug("Generating nametag with nametag()")
-        self.log.debug("Reading {0}...".format(os.path.join(directory, "default.html")))
-        f = open(os.path.join(directory, "default.html"))
-        html = f.read()
-        f.close()
-
-        if len(html) == 0:  # template file is empty: use default instead.
-            self.log.warn(
-                "HTML template file {0} is blank.".format(
-                    os.path.join(directory, "default.html")
-                )
-            )
+        template = self._get_theme(template).template
 
         # generate barcode of secure code, code128:
         if barcode:
             raise NotImplementedError()
-        # replace barcode image with white.gif
-        html = html.replace("default-secure.png", "white.gif")
         self.log.debug("Disabled barcode.")
 
-        # get the current date/time
-        now = datetime.datetime.now()
-
-        # Perform substitutions:
-        html = self.date_re.sub(now.strftime("%a %d %b, %Y"), html)
-        html = self.time_re.sub(now.strftime("%H:%M:%S"), html)
-        # Fix for if database returns None instead of empty string:
-        html = self.name_re.sub(name, html)
-        html = self.level_re.sub(str(level), html)
-        html = self.title_re.sub(str(title), html)
-        html = self.number_re.sub(str(number), html)
-        html = self.age_re.sub(str(age), html)
+        # Perform substitutions in a single pass:
+        values = self._values(template.fields, name, number, title, level, age)
+        return template.render(values)
 
-        return html
+    def nametags(self, tags, template="apis"):
+        """
+        Returns one HTML document containing a badge per entry in tags, each
+        on its own page, or None if the theme's HTML has no <body> to repeat.
+        The head and tail of the document are filled from the first badge.
+        """
+        theme = self._get_theme(template)
+        batch = theme.batch_templates
+        if batch is None or not tags:
+            return None
+        head, body, tail = batch
+
+        fields = theme.template.fields
+        values = [
+            self._values(
+                fields,
+                data["name"],
+                data["number"],
+                data["title"],
+                data["level"],
+                data["age"],
+            )
+            for data in tags
+        ]
+        parts = [head.render(values[0])]
+        for badge in values:
+            parts.append('<div class="apis-badge">')
+            parts.append(body.render(badge))
+            parts.append("</div>\n")
+        parts.append(tail.render(values[0]))
+        return "".join(parts)
+
+    def _get_theme(self, template):
+        # Check that theme specified is valid:
+        if template != "default":
+            themes = self._get_themes().list_templates()
+            if template not in themes:
+                self.log.error("Bad theme specified.  Using default instead.")
+                template = "default"
+        return self._get_themes().get(template)
+
+    def _values(self, fields, name="", number="", title="", level="", age=""):
+        """Returns the placeholder values for one badge."""
+        values = {
+            "name": name,
+            "level": str(level),
+            "title": str(title),
+            "number": str(number),
+            "age": str(age),
+        }
+        if "date" in fields or "time" in fields:
+            # get the current date/time
+            now = datetime.datetime.now()
+            values["date"] = now.strftime("%a %d %b, %Y")
+            values["time"] = now.strftime("%H:%M:%S")
+        return values
 
 
 class _DummyPrinter:
@@ -383,12 +1018,71 @@ class _DummyPrinter:
     def returnDefault(self):
         return ""
 
-    def printout(self, filename, printer=None, orientation=None):
+    def printout(
+        self, filename, printer=None, orientation=None, on_complete=None, raw=False
+    ):
         raise PrinterError("No printer system available")
 
 
+class RawPrinterSink:
+    """Sends raw printer language (e.g. ZPL) to a CUPS queue as a raw job."""
+
+    def __init__(self, con, printer=None, temp_dir=None):
+        self.con = con
+        self.printer = printer
+        self.temp_dir = temp_dir
+
+    def send(self, data, on_complete=None):
+        out = tempfile.NamedTemporaryFile(
+            delete=False, prefix="apis", suffix=".zpl", dir=self.temp_dir
+        )
+        try:
+            out.write(data)
+            out.close()
+            return self.con.printout(
+                out.name, self.printer, on_complete=on_complete, raw=True
+            )
+        finally:
+            os.unlink(out.name)
+
+
+class FileSink:
+    """Appends raw print jobs to a file, for trying layouts without a printer."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, data, on_complete=None):
+        with open(self.path, "ab") as f:
+            f.write(data)
+        return None
+
+
+# IPP job-state values
+JOB_STATES = {
+    3: "pending",
+    4: "held",
+    5: "processing",
+    6: "stopped",
+    7: "canceled",
+    8: "aborted",
+    9: "completed",
+}
+FINISHED_JOB_STATES = (7, 8, 9)
+
+
 class _CUPS:
-    def __init__(self):
+    """
+    Submits jobs through one cups.Connection shared by every Printer (see
+    shared()).  The printer list is cached and refreshed in the background
+    every INVENTORY_TTL seconds, and submitted jobs can be watched until
+    they finish.
+    """
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, ttl=INVENTORY_TTL, poll_interval=JOB_POLL_INTERVAL):
         self.log = logging.getLogger(__name__)
         self.log.info("Connecting to CUPS server on localhost...")
         try:
@@ -397,20 +1091,72 @@ class _CUPS:
             self.log.error(
                 "CUPS module not available.  Is CUPS installed? {0}".format(e)
             )
+        self.cups = cups
         self.con = cups.Connection()
+        # pycups connections must not be used from two threads at once
+        self.lock = threading.RLock()
+
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.inventory = None
+        self.inventory_time = None
+        self.default = None
+        self.refresher = None
+        self.jobs = {}  # job id -> on_complete callback
+        self.job_errors = {}  # job id -> failed checks in a row
+        self.monitor = None
+        self.stopping = threading.Event()
+
+    @classmethod
+    def shared(cls):
+        """Returns the connection shared by every Printer in this process."""
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
+
+    def _refresh(self):
+        with self.lock:
+            self.inventory = self.con.getPrinters()
+            self.default = self.con.getDefault()
+            self.inventory_time = time.monotonic()
+            return self.inventory
+
+    def _printers(self, refresh=False):
+        """Returns the cached getPrinters() result, refreshing it if stale."""
+        with self.lock:
+            if self.refresher is None:
+                self.refresher = threading.Thread(
+                    target=self._refresh_loop, name="cups-inventory", daemon=True
+                )
+                self.refresher.start()
+            if (
+                refresh
+                or self.inventory is None
+                or time.monotonic() - self.inventory_time > self.ttl
+            ):
+                return self._refresh()
+            return self.inventory
+
+    def _refresh_loop(self):
+        while not self.stopping.wait(self.ttl / 2):
+            try:
+                self._refresh()
+            except Exception as e:
+                self.log.warning("Unable to refresh CUPS printer list: {0}".format(e))
 
     def listPrinters(self):
         """
         Returns a list of the names of available system printers.
         """
-        return list(self.con.getPrinters().keys())
+        return list(self._printers().keys())
 
     def getPrinters(self):
         """
         Returns dictionary of printer name, description, location, and URI.
         """
         a = {}
-        printers = self.con.getPrinters()
+        printers = self._printers()
         for item in printers:
             info = printers[item]["printer-info"]
             location = printers[item]["printer-location"]
@@ -420,41 +1166,137 @@ class _CUPS:
 
     def getDefault(self):
         """Determines the user's default system or personal printer."""
-        return self.con.getDests()[None, None].name
+        with self.lock:
+            return self.con.getDests()[None, None].name
 
-    def printout(self, filename, printer=None, orientation=None):
-        if (
-            printer is not None
-        ):  # set printer; if none, then use default (leave argument blank)
-            if printer not in self.listPrinters():
+    def printout(
+        self,
+        filename,
+        printer=None,
+        orientation=None,
+        title=None,
+        on_complete=None,
+        raw=False,
+    ):
+        """
+        Submits filename to printer (the default destination if None) and
+        returns the CUPS job id.  If given, on_complete(job_id, state,
+        reasons) is called from a background thread once the job has
+        completed, been canceled or aborted.  raw=True sends the file to the
+        device as-is, bypassing the CUPS filters.
+        """
+        if printer is None:  # use default destination
+            self._printers()
+            printer = self.default
+            if printer is None:
+                raise PrinterError("No default printer is configured")
+        elif printer not in self._printers():
+            # Check again in case it was added since the last refresh
+            if printer not in self._printers(refresh=True):
                 raise PrinterError("Specified printer is not available on this system")
-            printArgs = ["-P", printer]
-        else:
-            printArgs = []
 
+        options = {}
         if orientation:  # set orientation option
             if orientation not in ["landscape", "portrait"]:
                 raise PrinterError(
                     "Bad orientation specification: {0}".format(orientation)
                 )
-            printArgs.append("-o")
-            printArgs.append(orientation)
+            options[orientation] = "true"  # same as lpr -o <orientation>
+        if raw:
+            options["raw"] = "true"
 
-        try:  # see if file exists
-            f = open(filename)
-        except IOError:
+        if not os.path.isfile(filename):
             raise PrinterError(
                 "The specified file does not exist: {0}".format(filename)
             )
-        else:
-            f.close()
-        printArgs.append(filename)  # append file to print.
 
-        ret = subprocess.check_call([LPR] + printArgs)
-        if ret != 0:
-            raise PrinterError(
-                "{0} exited non-zero ({1}).  Error spooling.".format(LPR, ret)
-            )
+        try:
+            with self.lock:
+                job_id = self.con.printFile(
+                    printer, filename, title or os.path.basename(filename), options
+                )
+        except self.cups.IPPError as e:
+            raise PrinterError("Error spooling to {0}: {1}".format(printer, e))
+        self.log.debug(
+            "Submitted {0} to {1} as job {2}".format(filename, printer, job_id)
+        )
+
+        if on_complete is not None:
+            self._watch(job_id, on_complete)
+        return job_id
+
+    def _watch(self, job_id, on_complete):
+        with self.lock:
+            self.jobs[job_id] = on_complete
+            if self.monitor is None:
+                self.monitor = threading.Thread(
+                    target=self._monitor_jobs, name="cups-jobs", daemon=True
+                )
+                self.monitor.start()
+
+    def _monitor_jobs(self):
+        while not self.stopping.wait(self.poll_interval):
+            with self.lock:
+                pending = list(self.jobs.items())
+            for job_id, on_complete in pending:
+                try:
+                    with self.lock:
+                        attributes = self.con.getJobAttributes(
+                            job_id,
+                            requested_attributes=["job-state", "job-state-reasons"],
+                        )
+                except self.cups.IPPError as e:
+                    # e.g. the job was purged from the server's history
+                    with self.lock:
+                        errors = self.job_errors.get(job_id, 0) + 1
+                        self.job_errors[job_id] = errors
+                    if errors < JOB_CHECK_RETRIES:
+                        self.log.warning(
+                            "Unable to check job {0}: {1}".format(job_id, e)
+                        )
+                        continue
+                    self.log.error(
+                        "Unable to check job {0}, no longer watching it: {1}".format(
+                            job_id, e
+                        )
+                    )
+                    self._finished(job_id, on_complete, "unknown", [str(e)])
+                    continue
+
+                with self.lock:
+                    self.job_errors.pop(job_id, None)
+                state = attributes.get("job-state")
+                if state not in FINISHED_JOB_STATES:
+                    continue
+                reasons = attributes.get("job-state-reasons", [])
+                if isinstance(reasons, str):
+                    reasons = [reasons]
+                self._finished(job_id, on_complete, JOB_STATES[state], reasons)
+
+    def _finished(self, job_id, on_complete, state, reasons):
+        """Stops watching job_id and reports its final state."""
+        with self.lock:
+            del self.jobs[job_id]
+            self.job_errors.pop(job_id, None)
+        try:
+            on_complete(job_id, state, reasons)
+        except Exception as e:
+            self.log.error("Job {0} completion callback failed: {1}".format(job_id, e))
+
+    def close(self):
+        """Stops the inventory refresh and job monitoring threads."""
+        self.stopping.set()
+        for thread in (self.refresher, self.monitor):
+            if thread is not None:
+                thread.join(self.poll_interval)
+
+    @classmethod
+    def close_shared(cls):
+        """Closes the shared connection, if one was opened."""
+        with cls._shared_lock:
+            shared, cls._shared = cls._shared, None
+        if shared is not None:
+            shared.close()
 
 
 class PrinterError(Exception):
@@ -468,12 +1310,145 @@ class PrinterError(Exception):
         return repr(self.error)
 
 
+class PdfCache:
+    """
+    Size-bounded LRU cache of rendered badge PDFs in a directory.  Entries
+    are keyed by a hash of the theme version, the render arguments and the
+    badge fields, so previewing and then printing the same badges, or
+    reprinting them later, reuses the PDF.  Themes that print %TIME% are
+    never cached; themes that print %DATE% are cached for the day.
+    """
+
+    # Badge fields that are substituted into the theme
+    FIELDS = ("name", "number", "title", "level", "age")
+
+    def __init__(self, directory, max_bytes=100 * 1024 * 1024):
+        self.log = logging.getLogger(__name__)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()  # key -> size, oldest first
+        self.size = 0
+        self.stats = {"hits": 0, "misses": 0, "bypasses": 0, "evictions": 0}
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _path(self, key):
+        return os.path.join(self.directory, "{0}.pdf".format(key))
+
+    def _load(self):
+        """Picks up entries from a previous run, least recently used first."""
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".pdf"):
+                st = os.stat(os.path.join(self.directory, name))
+                files.append((st.st_mtime_ns, name[:-4], st.st_size))
+        for mtime, key, size in sorted(files):
+            self.entries[key] = size
+            self.size += size
+        with self.lock:
+            self._evict()
+
+    def key(self, theme, args, tags, batch=True, backend=None):
+        """Returns the cache key for rendering tags, or None if uncacheable."""
+        fields = theme.template.fields
+        if "time" in fields:
+            with self.lock:
+                self.stats["bypasses"] += 1
+            return None
+
+        material = {
+            "theme": theme.name,
+            "version": theme.version,
+            "args": [str(arg) for arg in args],
+            "batch": batch,
+            "backend": type(backend).__name__,
+            "badges": [[str(tag.get(f, "")) for f in self.FIELDS] for tag in tags],
+        }
+        if "date" in fields:
+            material["date"] = datetime.date.today().isoformat()
+        encoded = json.dumps(material, sort_keys=True).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def get(self, key, temp_dir=None):
+        """
+        Returns the name of a temporary copy of the cached PDF, made in
+        temp_dir, which the caller should unlink, or None if key is not
+        cached.
+        """
+        with self.lock:
+            if key not in self.entries:
+                self.stats["misses"] += 1
+                return None
+            path = self._path(key)
+            try:
+                os.utime(path)  # keeps the LRU order across restarts
+                pdf = self._copy(path, temp_dir)
+            except OSError as e:
+                self.log.warning("Dropping cached pdf {0}: {1}".format(path, e))
+                self.size -= self.entries.pop(key)
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return pdf
+
+    @staticmethod
+    def _copy(path, temp_dir=None):
+        out = tempfile.NamedTemporaryFile(
+            delete=False, prefix="apis", suffix=".pdf", dir=temp_dir
+        )
+        with open(path, "rb") as f:
+            shutil.copyfileobj(f, out)
+        out.close()
+        return out.name
+
+    def put(self, key, pdf):
+        """Stores a copy of the PDF file pdf under key."""
+        path = self._path(key)
+        shutil.copyfile(pdf, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        size = os.path.getsize(path)
+        with self.lock:
+            self.size -= self.entries.pop(key, 0)
+            self.entries[key] = size
+            self.size += size
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_bytes and self.entries:
+            key, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.stats["evictions"] += 1
+            try:
+                os.unlink(self._path(key))
+            except OSError:
+                pass
+
+
+# Set to a PdfCache to reuse rendered badges in Main
+pdf_cache = None
+
+
+# Shared by every Nametag/Main so themes are only read from disk once
+registry = ThemeRegistry()
+
+
 class Main:
-    def __init__(self, local=False):
+    def __init__(self, local=False, job=None):
+        """
+        If job (a workspace.JobWorkspace) is given, every file made while
+        rendering, including the returned PDFs, is created in its directory
+        and removed with it.
+        """
         self.log = logging.getLogger(__name__)
-        self.con = Printer(True)
+        self.con = Printer(local)
         self.tag = Nametag(True)
         self.section = ""
+        self.job = job
+        if job is not None:
+            self.con.temp_dir = job.path
 
     def nametag(
         self,
@@ -490,48 +1465,337 @@ class Main:
         """Note: section= not fully implemented in Nametag.nametag method"""
         self.section = section
         self.conf = self.tag.read_config(theme)  # theme
-        self.args = self.con.buildArguments(self.conf, section)  # section
+        self.args = self.tag._get_themes().get(theme).arguments(self.con, section)
 
         stuff = self.tag.nametag(
             name=name, number=number, title=title, template=theme, level=level
         )
-        temp_path = self.tag._get_template_path(theme)
-        html = tempfile.NamedTemporaryFile(delete=False, dir=temp_path, suffix=".html")
-        html.write(stuff.encode("utf-8"))
-        html.close()
-
-        self.pdf = self.con.writePdf(self.args, html.name)
-        os.unlink(html.name)
+        html_file = self._write_html(theme, stuff)
+        try:
+            self.pdf = self.con.writePdf(self.args, html_file)
+        finally:
+            os.unlink(html_file)
         return self.pdf
 
-    def nametags(self, tags, theme="apis", section="default"):
+    def nametags(
+        self,
+        tags,
+        theme="apis",
+        section="default",
+        batch=True,
+        shard_size=None,
+        workers=None,
+    ):
+        """
+        Renders a PDF with one page per badge.  With batch=True the badges
+        are combined into a single HTML document so wkhtmltopdf parses the
+        theme and loads its stylesheets, fonts and images only once; themes
+        without a <body> element fall back to one HTML file per badge.
+
+        If shard_size is set, batches larger than it are split into shards of
+        shard_size badges that are rendered concurrently by up to workers
+        renderer processes (default: one per CPU) and merged in order.
+        """
         self.section = section
         self.conf = self.tag.read_config(theme)  # theme
-        self.args = self.con.buildArguments(self.conf, section)  # section
+        self.args = self.tag._get_themes().get(theme).arguments(self.con, section)
+
+        if shard_size and len(tags) > shard_size:
+            if can_merge_pdfs():
+                self.pdf = self._render_shards(tags, theme, batch, shard_size, workers)
+                return self.pdf
+            self.log.warning(
+                "pypdf and {0} are unavailable; rendering {1} badges in one pass".format(
+                    PDFUNITE, len(tags)
+                )
+            )
+
+        self.pdf = self._render(tags, theme, batch)
+        return self.pdf
+
+    def _render(self, tags, theme, batch=True):
+        """
+        Renders tags to a single temporary PDF and returns its name, reusing
+        a copy from pdf_cache if the same badges were rendered before.
+        """
+        cache = pdf_cache
+        key = None
+        if cache is not None:
+            key = cache.key(
+                self.tag._get_theme(theme),
+                self.args,
+                tags,
+                batch,
+                self.con.backend or default_backend,
+            )
+            if key is not None:
+                pdf = cache.get(key, self.con.temp_dir)
+                if pdf is not None:
+                    self.log.debug(
+                        "Reusing cached pdf for {0} badges".format(len(tags))
+                    )
+                    return pdf
+
+        pdf = self._render_pdf(tags, theme, batch)
+        if key is not None:
+            try:
+                cache.put(key, pdf)
+            except OSError as e:
+                self.log.warning("Unable to cache pdf: {0}".format(e))
+        return pdf
+
+    def _render_pdf(self, tags, theme, batch=True):
+        if batch:
+            stuff = self.tag.nametags(tags, template=theme)
+            if stuff is not None:
+                html_file = self._write_html(theme, stuff)
+                try:
+                    return self.con.writePdf(self.args, html_file)
+                finally:
+                    os.unlink(html_file)
+            self.log.warning(
+                "Cannot combine badges for theme {0}; using one file per badge".format(
+                    theme
+                )
+            )
 
         html_files = []
-        for data in tags:
-            stuff = self.tag.nametag(
-                name=data["name"],
-                number=data["number"],
-                title=data["title"],
-                template=theme,
-                level=data["level"],
-                age=data["age"],
+        try:
+            for data in tags:
+                stuff = self.tag.nametag(
+                    name=data["name"],
+                    number=data["number"],
+                    title=data["title"],
+                    template=theme,
+                    level=data["level"],
+                    age=data["age"],
+                )
+                html_files.append(self._write_html(theme, stuff))
+
+            return self.con.writePdf(self.args, html_files)
+        finally:
+            for tmpname in html_files:
+                os.unlink(tmpname)
+
+    def _render_shards(self, tags, theme, batch, shard_size, workers=None):
+        """
+        Renders tags in shards on a thread pool and merges the PDFs in badge
+        order.  The threads only wait on the renderer processes, which do the
+        work in parallel.
+        """
+        shards = self._shards(tags, shard_size)
+        workers = min(workers or os.cpu_count() or 1, len(shards))
+        self.log.debug(
+            "Rendering {0} badges in {1} shards on {2} workers".format(
+                len(tags), len(shards), workers
             )
-            temp_path = self.tag._get_template_path(theme)
-            html = tempfile.NamedTemporaryFile(
-                delete=False, dir=temp_path, suffix=".html"
+        )
+        with ThreadPoolExecutor(workers, thread_name_prefix="badge-shard") as pool:
+            futures = [
+                pool.submit(self._render, shard, theme, batch) for shard in shards
+            ]
+        return self._merge_rendered(futures)
+
+    def _shards(self, tags, shard_size):
+        """Splits tags into lists of up to shard_size badges (None: one list)."""
+        shard_size = shard_size or len(tags) or 1
+        return [tags[i : i + shard_size] for i in range(0, len(tags), shard_size)]
+
+    def _merge_rendered(self, futures):
+        """
+        Waits for futures rendering PDFs and returns one temporary PDF with
+        their pages in order.  The rendered PDFs are removed once merged.
+        """
+        pdfs = []
+        error = None
+        for future in futures:
+            try:
+                pdfs.append(future.result())
+            except Exception as e:
+                error = error or e
+
+        if error is None and len(pdfs) == 1:
+            return pdfs[0]
+        try:
+            if error is not None:
+                raise error
+            out = tempfile.NamedTemporaryFile(
+                delete=False, prefix="apis", suffix=".pdf", dir=self.con.temp_dir
             )
-            html.write(stuff.encode("utf-8"))
-            html.close()
-            html_files.append(html.name)
-
-        self.pdf = self.con.writePdf(self.args, html_files)
-        for tmpname in html_files:
-            # os.unlink(tmpname)
-            pass
-        return self.pdf
+            out.close()
+            try:
+                merge_pdfs(pdfs, out.name)
+            except Exception:
+                os.unlink(out.name)
+                raise
+            return out.name
+        finally:
+            for pdf in pdfs:
+                os.unlink(pdf)
+
+    def print_nametags(
+        self,
+        tags,
+        theme="apis",
+        section="default",
+        batch=True,
+        chunk_size=10,
+        workers=None,
+        printer=None,
+        orientation=None,
+        progress=None,
+        on_complete=None,
+        shard_size=None,
+    ):
+        """
+        Prints tags as a series of print jobs of chunk_size badges each.
+        Chunks are rendered concurrently by up to workers renderer processes
+        and each is sent to the printer, in order, as soon as it is ready, so
+        the first badges print while later ones are still rendering.
+        progress(printed, total, job_id) is called after each chunk is
+        submitted, and on_complete is passed on to the printer (see
+        _CUPS.printout).  A chunk_size of None prints the whole batch as one
+        job.  Chunks larger than shard_size are rendered in shards on the
+        same workers and merged, as in nametags().  Returns the list of job
+        ids.
+        """
+        self.section = section
+        self.conf = self.tag.read_config(theme)  # theme
+        self.args = self.tag._get_themes().get(theme).arguments(self.con, section)
+        if orientation is None:
+            orientation = self.conf[section]["orientation"].lower()
+
+        chunks = self._shards(tags, chunk_size)
+        if not chunks:
+            return []
+        if shard_size and shard_size < len(chunks[0]) and not can_merge_pdfs():
+            self.log.warning(
+                "pypdf and {0} are unavailable; rendering chunks in one pass".format(
+                    PDFUNITE
+                )
+            )
+            shard_size = None
+        shards = [self._shards(chunk, shard_size) for chunk in chunks]
+        workers = min(workers or os.cpu_count() or 1, sum(map(len, shards)))
+
+        printed = 0
+        job_ids = []
+        pool = ThreadPoolExecutor(workers, thread_name_prefix="badge-chunk")
+        futures = [
+            [pool.submit(self._render, shard, theme, batch) for shard in chunk_shards]
+            for chunk_shards in shards
+        ]
+        try:
+            for i, chunk in enumerate(chunks):
+                pdf = self._merge_rendered(futures[i])
+                try:
+                    job_id = self.con.printout(
+                        pdf, printer, orientation, on_complete=on_complete
+                    )
+                finally:
+                    os.unlink(pdf)
+                job_ids.append(job_id)
+                printed += len(chunk)
+                self.log.debug(
+                    "Sent chunk {0}/{1} ({2}/{3} badges)".format(
+                        i + 1, len(chunks), printed, len(tags)
+                    )
+                )
+                if progress is not None:
+                    progress(printed, len(tags), job_id)
+        finally:
+            # Don't leave PDFs behind for chunks that were never printed
+            unprinted = [future for chunk in futures[i + 1 :] for future in chunk]
+            for future in unprinted:
+                future.cancel()
+            pool.shutdown(wait=True)
+            for future in unprinted:
+                if not future.cancelled() and future.exception() is None:
+                    os.unlink(future.result())
+        return job_ids
+
+    def preview_image(self, tags, theme="apis", section="default"):
+        """
+        Renders only the first badge in tags to a screen resolution PNG and
+        returns the image data.  Much cheaper than the print-quality PDF.
+        """
+        if not tags:
+            raise PrinterError("No badges to preview")
+        self.section = section
+        self.conf = self.tag.read_config(theme)  # theme
+        self.args = self.tag._get_themes().get(theme).arguments(self.con, section)
+
+        data = tags[0]
+        stuff = self.tag.nametag(
+            name=data["name"],
+            number=data["number"],
+            title=data["title"],
+            template=theme,
+            level=data["level"],
+            age=data["age"],
+        )
+        html_file = self._write_html(theme, stuff)
+        try:
+            png = self.con.writePng(self.args, html_file)
+        finally:
+            os.unlink(html_file)
+        try:
+            with open(png, "rb") as f:
+                return f.read()
+        finally:
+            os.unlink(png)
+
+    def print_labels(
+        self, tags, theme="apis", printer=None, sink=None, on_complete=None
+    ):
+        """
+        Prints tags as ZPL labels laid out by the theme's [layout] section,
+        skipping HTML, PDF and the CUPS filter chain.  Labels go to sink,
+        by default a raw CUPS job on printer.  Returns the job id, if any.
+        """
+        layout = self.tag._get_theme(theme).layout
+        if layout is None:
+            raise PrinterError("Theme {0} has no [layout] section".format(theme))
+
+        labels = []
+        for data in tags:
+            values = self.tag._values(
+                layout.fields,
+                data["name"],
+                data["number"],
+                data["title"],
+                data["level"],
+                data["age"],
+            )
+            labels.append(layout.label(values))
+
+        if sink is None:
+            sink = RawPrinterSink(self.con, printer, self.con.temp_dir)
+        return sink.send("".join(labels).encode("utf-8"), on_complete=on_complete)
+
+    def _write_html(self, theme, stuff):
+        """
+        Writes HTML to a temporary file in the job directory (or the system
+        temporary directory without a job) and returns its name.  A <base>
+        element pointing at the theme directory resolves relative stylesheet
+        and image paths; writing into the theme directory instead would change
+        its stamp and version.
+        """
+        stuff = self._with_base(stuff, self.tag._get_template_path(theme))
+        temp_path = self.job.path if self.job is not None else None
+        html = tempfile.NamedTemporaryFile(delete=False, dir=temp_path, suffix=".html")
+        html.write(stuff.encode("utf-8"))
+        html.close()
+        return html.name
+
+    @staticmethod
+    def _with_base(html, directory):
+        """Returns html with relative URLs resolved against directory."""
+        base = '<base href="{0}/">'.format(pathlib.Path(directory).resolve().as_uri())
+        match = HEAD_RE.search(html)
+        if match is None:
+            return base + html
+        return html[: match.end()] + base + html[match.end() :]
 
     def preview(self, filename=None):
         if filename is None:
@@ -543,7 +1807,7 @@ class Main:
             filename = self.pdf
         if orientation is None:
             orientation = self.conf[self.section]["orientation"]
-        self.con.printout(filename, printer, orientation)
+        return self.con.printout(filename, printer, orientation)
 
     def cleanup(self, trash=None):
         self.log.debug("Cleaning up files...")
@@ -0,0 +1,262 @@
+"""
+Declarative receipt layouts.  A template is a list of section names (or
+("center", text) tuples for fixed captions).  ReceiptLayout compiles it once:
+runs of static sections (blank lines, rules, the wrapped legal footer) are
+formatted up front and rendered to ESC/POS bytes once per printer profile, so
+each receipt only formats the sections that depend on the payload.
+"""
+
+import logging
+from formatter import ReceiptFormatter
+
+from logo import profile_name
+from printer_session import buffer_for
+
+logger = logging.getLogger(__name__)
+
+RECEIPT_TEMPLATE = [
+    "ln",
+    "event",
+    "ln",
+    "line_items",
+    "ln",
+    "donations",
+    "ln",
+    "total",
+    "ln",
+    "hr",
+    "ln",
+    "payment",
+    "ln",
+    "hr",
+    "ln",
+    "footer",
+]
+
+AUDIT_SLIP_TEMPLATE = [
+    "ln",
+    "ln",
+    "event",
+    "ln",
+    ("center", "Cash Audit Report"),
+    "ln",
+    "hr",
+    "ln",
+    "audit_user",
+    "ln",
+    "audit_action",
+    "ln",
+    "audit_amount",
+    "ln",
+    "hr",
+    "ln",
+    "timestamp",
+]
+
+
+def event_section(builder, payload):
+    builder.center_text(payload.get("event", "APIS"))
+
+
+def line_items_section(builder, payload):
+    for line in payload["line_items"]:
+        builder.format_line_item(line.get("item"), line.get("price"))
+
+
+def donations_section(builder, payload):
+    donations = payload.get("donations")
+    if donations:
+        org = donations.get("org")
+        if org:
+            builder.format_line_item(f"Donation to {org['name']}", org["price"])
+
+        charities_list = donations.get("charity")
+        logger.debug(f"charity = {charities_list}")
+        for charity in charities_list:
+            builder.format_line_item(f"Donation to {charity['name']}", charity["price"])
+
+
+def total_section(builder, payload):
+    builder.right_text(f"Total Due:  {payload['total']}")
+
+
+def payment_section(builder, payload):
+    payment = payload.get("payment")
+
+    if payment:
+        builder.format_line_item(payment["type"], payment["tendered"])
+
+        details = payment.get("details")
+        if details:
+            builder.append(details)
+
+        change = payment.get("change")
+        if change:
+            builder.right_text(f"Change:  {change}")
+
+
+def audit_user_section(builder, payload):
+    builder.format_line_item(
+        f"User: {payload.get('user')}", f"Register: {payload.get('terminal')}"
+    )
+
+
+def audit_action_section(builder, payload):
+    builder.center_text(f"Audit Action: {payload.get('type')}")
+
+
+def audit_amount_section(builder, payload):
+    builder.format_line_item("Amount:", payload.get("amount"))
+
+
+def timestamp_section(builder, payload):
+    builder.center_text(payload.get("timestamp"))
+
+
+SECTIONS = {
+    "event": event_section,
+    "line_items": line_items_section,
+    "donations": donations_section,
+    "total": total_section,
+    "payment": payment_section,
+    "audit_user": audit_user_section,
+    "audit_action": audit_action_section,
+    "audit_amount": audit_amount_section,
+    "timestamp": timestamp_section,
+}
+
+
+class StaticPart(object):
+    """Pre-formatted lines plus their ESC/POS encoding for each profile."""
+
+    def __init__(self, lines):
+        self.text = "\n".join(lines)
+        self.encoded = {}
+
+    def render(self, printer, separator):
+        """
+        Writes the encoded text to printer, preceded by a newline if separator
+        is set.
+        """
+        key = (profile_name(printer), separator)
+        encoded = self.encoded.get(key)
+        if encoded is None:
+            buffer = buffer_for(printer)
+            buffer.text("\n" + self.text if separator else self.text)
+            encoded = self.encoded[key] = (buffer.output, buffer.magic.encoding)
+
+        data, encoding = encoded
+        printer._raw(data)
+        # Tell the printer's encoder which code page the bytes left selected
+        printer.magic.encoding = encoding
+
+
+class DynamicPart(object):
+    def __init__(self, section):
+        self.section = section
+
+
+class ReceiptLayout(object):
+    def __init__(self, template, footer="", width=48, margin=2, left_margin=2):
+        self.template = template
+        self.footer = footer
+        self.formatter_settings = {
+            "width": width,
+            "margin": margin,
+            "left_margin": left_margin,
+        }
+        self.parts = self._compile()
+
+    def _static_lines(self, entry):
+        """Returns the formatted lines of a static section, or None if dynamic."""
+        builder = ReceiptFormatter(**self.formatter_settings)
+        if entry == "ln":
+            builder.ln()
+        elif entry == "hr":
+            builder.hr()
+        elif entry == "footer":
+            builder.wrap_center(self.footer)
+        elif isinstance(entry, (tuple, list)) and entry[0] == "center":
+            builder.center_text(entry[1])
+        elif entry in SECTIONS:
+            return None
+        else:
+            raise ValueError(f"Unknown receipt template section {entry!r}")
+        return builder.lines
+
+    def _compile(self):
+        parts = []
+        static = []
+        for entry in self.template:
+            lines = self._static_lines(entry)
+            if lines is None:
+                if static:
+                    parts.append(StaticPart(static))
+                    static = []
+                parts.append(DynamicPart(SECTIONS[entry]))
+            else:
+                static.extend(lines)
+        if static:
+            parts.append(StaticPart(static))
+        return parts
+
+    def render(self, printer, payload):
+        """
+        Sends the receipt body to printer and returns it as text.  Prints the
+        same as formatting every section into one ReceiptFormatter and calling
+        printer.text(builder.pop()).
+        """
+        builder = ReceiptFormatter(**self.formatter_settings)
+        texts = []
+        for part in self.parts:
+            separator = len(texts) > 0
+            if isinstance(part, StaticPart):
+                part.render(printer, separator)
+                texts.append(part.text)
+                continue
+
+            part.section(builder, payload)
+            if builder.lines:
+                text = builder.pop()
+                printer.text("\n" + text if separator else text)
+                texts.append(text)
+
+        return "\n".join(texts)
+
+    def stream(self, printer, payload, echo=None, flush_lines=16):
+        """
+        Like render(), but dynamic sections pass their text to the printer
+        every flush_lines lines rather than when complete, and no text is
+        kept.  echo, if given, is called with each chunk as it is sent.
+        """
+        started = False
+        for part in self.parts:
+            if isinstance(part, StaticPart):
+                part.render(printer, started)
+                if echo:
+                    echo(part.text)
+                started = True
+                continue
+
+            sink = self._stream_sink(printer, echo, started)
+            builder = ReceiptFormatter(
+                sink=sink, flush_lines=flush_lines, **self.formatter_settings
+            )
+            part.section(builder, payload)
+            builder.flush()
+            started = started or builder.flushed
+
+    @staticmethod
+    def _stream_sink(printer, echo, separator):
+        """Returns a sink that separates the section from earlier output."""
+        first = [True]
+
+        def sink(text):
+            if echo:
+                echo(text.lstrip("\n"))
+            if first[0] and separator:
+                text = "\n" + text
+            first[0] = False
+            printer.text(text)
+
+        return sink
@@ -0,0 +1,179 @@
+"""
+Long-running badge renderer.  Run as a child process by
+printing.PersistentBackend: it imports WeasyPrint once, then reads render jobs
+from stdin and writes PDF bytes back to stdout, so fonts, stylesheets and the
+HTML engine stay loaded between badges.
+
+Messages in both directions are a 4 byte big-endian length followed by a
+pickle.  A job is (args, html_files) where args are the wkhtmltopdf arguments
+printing.Printer.buildArguments produced; the reply is (True, pdf_bytes) or
+(False, error_message).  The first message the service sends says whether the
+renderer could be loaded.
+"""
+
+import pickle
+import re
+import struct
+import sys
+
+HEADER = struct.Struct(">I")
+
+# wkhtmltopdf's defaults for margins that are not set in the theme
+DEFAULT_MARGIN = "10mm"
+
+UNIT_RE = re.compile(r"^[0-9.]+$")
+LENGTH_RE = re.compile(r"^([0-9.]+)\s*([a-z]*)$", re.IGNORECASE)
+
+# Named page sizes (portrait, in mm) that can be scaled for --zoom
+PAGE_SIZES = {
+    "a3": (297, 420),
+    "a4": (210, 297),
+    "a5": (148, 210),
+    "a6": (105, 148),
+    "b5": (176, 250),
+    "letter": (215.9, 279.4),
+    "legal": (215.9, 355.6),
+}
+
+
+def send_message(stream, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    stream.write(HEADER.pack(len(data)) + data)
+    stream.flush()
+
+
+def recv_message(stream):
+    """Returns the next message, or raises EOFError if the stream closed."""
+    header = _read_exactly(stream, HEADER.size)
+    return pickle.loads(_read_exactly(stream, HEADER.unpack(header)[0]))
+
+
+def _read_exactly(stream, size):
+    data = b""
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise EOFError("Render service pipe closed")
+        data += chunk
+    return data
+
+
+def _length(value):
+    """wkhtmltopdf reads lengths without a unit as millimetres."""
+    value = str(value).strip()
+    return value + "mm" if UNIT_RE.match(value) else value
+
+
+def _scaled(value, scale):
+    """Returns the wkhtmltopdf length value multiplied by scale, as CSS."""
+    if scale == 1:
+        return _length(value)
+    match = LENGTH_RE.match(_length(value))
+    if match is None:
+        raise ValueError(f"Cannot scale page length {value!r} for --zoom")
+    return f"{float(match.group(1)) * scale:.4f}{match.group(2)}"
+
+
+def page_options(args):
+    """
+    Translates wkhtmltopdf arguments into a stylesheet (the @page size and
+    margins), the zoom to pass to write_pdf(), the number of copies and
+    whether to collate them.  Options without a CSS equivalent (e.g.
+    --enable-local-file-access) are ignored.
+
+    wkhtmltopdf's --zoom scales the content but not the page, while
+    WeasyPrint's write_pdf(zoom=) scales both.  So a zoomed page is laid out
+    at 1/zoom of its size and margins and zoomed back up, which paginates the
+    content as wkhtmltopdf would.  Raises ValueError for a zoomed page size
+    it cannot scale, so the badge is rendered by wkhtmltopdf instead.
+    """
+    options = {}
+    flags = set()
+    args = [str(arg) for arg in args]
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg in ("--enable-local-file-access", "--collate"):
+            flags.add(arg)
+        elif i + 1 < len(args):
+            options[arg] = args[i + 1]
+            i += 1
+        i += 1
+
+    zoom = float(options.get("--zoom", 1))
+    scale = 1 / zoom
+    width = options.get("--page-width")
+    height = options.get("--page-height")
+    if width and height:
+        # wkhtmltopdf ignores --orientation for custom page sizes; CUPS
+        # rotates the printed page instead
+        size = f"{_scaled(width, scale)} {_scaled(height, scale)}"
+    elif zoom != 1:
+        name = options.get("-s", "A4")
+        if name.lower() not in PAGE_SIZES:
+            raise ValueError(f"Cannot scale page size {name!r} for --zoom")
+        width, height = PAGE_SIZES[name.lower()]
+        if options.get("--orientation", "").lower() == "landscape":
+            width, height = height, width
+        size = f"{_scaled(width, scale)} {_scaled(height, scale)}"
+    else:
+        size = options.get("-s", "A4")
+        if options.get("--orientation", "").lower() == "landscape":
+            size += " landscape"
+
+    margins = "; ".join(
+        f"margin-{side}: "
+        f"{_scaled(options.get('--margin-' + side, DEFAULT_MARGIN), scale)}"
+        for side in ("top", "right", "bottom", "left")
+    )
+    css = f"@page {{ size: {size}; {margins} }}"
+    copies = int(options.get("--copies", 1))
+    return css, zoom, copies, "--collate" in flags
+
+
+def render(weasyprint, args, html_files):
+    css, zoom, copies, collate = page_options(args)
+    stylesheet = weasyprint.CSS(string=css)
+    documents = [
+        weasyprint.HTML(filename=html, media_type="screen").render(
+            stylesheets=[stylesheet]
+        )
+        for html in html_files
+    ]
+    pages = [page for document in documents for page in document.pages]
+    if collate:
+        pages = pages * copies
+    else:
+        pages = [page for page in pages for _ in range(copies)]
+    return documents[0].copy(pages).write_pdf(zoom=zoom)
+
+
+def serve(stdin, stdout):
+    try:
+        import weasyprint
+    except ImportError as e:
+        send_message(stdout, (False, f"WeasyPrint is not available: {e}"))
+        return
+    send_message(stdout, (True, weasyprint.__version__))
+
+    while True:
+        try:
+            job = recv_message(stdin)
+        except EOFError:
+            return
+        if job is None:
+            return
+
+        args, html_files = job
+        try:
+            reply = (True, render(weasyprint, args, html_files))
+        except Exception as e:
+            reply = (False, f"{type(e).__name__}: {e}")
+        send_message(stdout, reply)
+
+
+if __name__ == "__main__":
+    # Keep stray prints from libraries off the reply pipe
+    reply_pipe = sys.stdout.buffer
+    sys.stdout = sys.stderr
+    serve(sys.stdin.buffer, reply_pipe)
@@ -0,0 +1,104 @@
+"""Decodes scans off the reader thread, delivering results in scan order"""
+
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from metrics import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+
+class OrderedDecoder(object):
+    """
+    Runs barcode decoders (e.g. SMART Health Card verification) on a pool of
+    worker threads so the reader can go back to the scanner straight away.
+    Each scan's result is handed to its callback on a single delivery
+    thread, in the order the scans were submitted, even when a later scan
+    decodes first.
+
+    Decode time is recorded per decoder in self.timings; self.scan_times
+    covers submit to delivery.  When max_pending scans are waiting, submit()
+    blocks, which leaves further input in the scanner's buffer.
+    """
+
+    def __init__(self, workers=2, max_pending=100):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="decoder")
+        self.pending = collections.deque()
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.ready = threading.Condition()
+        self.stopping = False
+        self.timings = {}
+        self.timings_lock = threading.Lock()
+        self.scan_times = LatencyHistogram("scan decode and delivery")
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._deliver, name="decoder-delivery", daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, name, decode, value, callback):
+        """
+        Queues callback(decode(value)), or callback(value) without a decoder
+        so cheap scans keep their place in the order.
+        """
+        self.slots.acquire()
+        if decode is None:
+            future = Future()
+            future.set_result(value)
+        else:
+            future = self.executor.submit(self._timed, name, decode, value)
+        with self.ready:
+            self.pending.append((name, future, callback, time.monotonic()))
+            self.ready.notify()
+
+    def stop(self, timeout=None):
+        """Delivers what has been submitted, then stops the threads."""
+        with self.ready:
+            self.stopping = True
+            self.ready.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self.executor.shutdown(wait=False)
+
+    def _timer(self, name):
+        with self.timings_lock:
+            if name not in self.timings:
+                self.timings[name] = LatencyHistogram(f"{name} decoder")
+            return self.timings[name]
+
+    def _timed(self, name, decode, value):
+        start = time.monotonic()
+        try:
+            return decode(value)
+        finally:
+            self._timer(name).observe_since(start, time.monotonic())
+
+    def _deliver(self):
+        while True:
+            with self.ready:
+                while not self.pending and not self.stopping:
+                    self.ready.wait()
+                if not self.pending:
+                    return
+                name, future, callback, submitted = self.pending[0]
+
+            # Wait for the oldest scan, even if later ones are done
+            try:
+                result = future.result()
+            except Exception:
+                logger.exception(f"Could not decode {name} scan")
+            else:
+                try:
+                    callback(result)
+                except Exception:
+                    logger.exception(f"Could not handle {name} scan")
+
+            with self.ready:
+                self.pending.popleft()
+            self.slots.release()
+            self.scan_times.observe_since(submitted, time.monotonic())
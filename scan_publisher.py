@@ -0,0 +1,301 @@
+"""Long-lived MQTT connection for publishing scanner events"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from metrics import LatencyHistogram
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTBOX = "scanner-outbox.sqlite3"
+
+
+class ScanOutbox(object):
+    """
+    Scanner events waiting to be published, kept in a SQLite database so they
+    survive broker outages and restarts.  Messages are read back in the order
+    they were added and deleted once the broker has them.  Use path
+    ":memory:" for an outbox that is not kept on disk.
+    """
+
+    def __init__(self, path=DEFAULT_OUTBOX):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            # Appends are a write to the log, not a rewrite of the database
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "topic TEXT NOT NULL, payload TEXT NOT NULL, qos INTEGER NOT NULL, "
+            "created REAL NOT NULL)"
+        )
+        self.db.commit()
+        self.count = self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def __len__(self):
+        return self.count
+
+    def put(self, topic, payload, qos):
+        """Adds a message; returns its id."""
+        with self.lock:
+            cursor = self.db.execute(
+                "INSERT INTO outbox (topic, payload, qos, created) VALUES (?, ?, ?, ?)",
+                (topic, payload, qos, time.time()),
+            )
+            self.db.commit()
+            self.count += 1
+            return cursor.lastrowid
+
+    def batch(self, after=0, limit=50):
+        """Returns up to limit (id, topic, payload, qos) rows with ids after after."""
+        with self.lock:
+            return self.db.execute(
+                "SELECT id, topic, payload, qos FROM outbox WHERE id > ? "
+                "ORDER BY id LIMIT ?",
+                (after, limit),
+            ).fetchall()
+
+    def remove(self, ids):
+        if not ids:
+            return
+        with self.lock:
+            self.db.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in ids])
+            self.db.commit()
+            self.count -= len(ids)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class _TimedClient(mqtt.Client):
+    """Notes when each connection attempt starts, for connect latency."""
+
+    connect_started = None
+
+    def reconnect(self):
+        self.connect_started = time.monotonic()
+        return super().reconnect()
+
+
+class ScanPublisher(object):
+    """
+    Publishes scanner events over one MQTT connection that stays open
+    between scans, instead of connecting (and authenticating) per message.
+
+    publish() only adds the message to a ScanOutbox on disk; a sender thread
+    publishes the outbox in batches of up to batch_size unacknowledged
+    messages while the client is connected, and removes messages once the
+    broker acknowledges them (QoS 1 and 2) or they are written to the socket
+    (QoS 0).  A scan therefore never waits on the broker, and scans made
+    while it is unreachable are sent when the connection comes back, or after
+    a restart.  Delivery is at least once: a message sent just before a crash
+    may be sent again.
+
+    The paho network loop runs in its own thread (loop_start) and reconnects
+    with a backoff between min_delay and max_delay seconds.  When max_queued
+    messages are waiting, new ones are dropped.
+    """
+
+    def __init__(
+        self,
+        broker,
+        login=None,
+        tls=None,
+        qos=1,
+        client_id="",
+        max_queued=10000,
+        min_delay=1,
+        max_delay=30,
+        outbox=DEFAULT_OUTBOX,
+        batch_size=50,
+    ):
+        self.broker = dict(broker)
+        self.qos = qos
+        self.max_queued = max_queued
+        self.batch_size = batch_size
+        self.outbox = ScanOutbox(outbox)
+        self.connected = threading.Event()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        # mid -> (outbox id, QoS, time.monotonic() when handed to paho), and
+        # the ack time for the rare ack that arrives before publish() returns
+        self.in_flight = {}
+        self.early_acks = {}
+        self.acked = []
+        # Highest outbox id handed to paho by this process, and where to
+        # restart from after QoS 0 messages were lost with a connection
+        self.cursor = 0
+        self.rewind = None
+        self.stats = {"published": 0, "dropped": 0, "connects": 0, "disconnects": 0}
+        self.connect_times = LatencyHistogram("MQTT connect")
+        self.publish_times = LatencyHistogram("MQTT publish")
+        self.thread = None
+
+        if len(self.outbox):
+            logger.info(f"{len(self.outbox)} scanner messages waiting in outbox")
+
+        client = _TimedClient(client_id=client_id)
+        client.enable_logger(logger=logger)
+        if login:
+            client.username_pw_set(**login)
+        if tls:
+            tls = dict(tls)
+            insecure = tls.pop("insecure", False)
+            client.tls_set(**tls)
+            if insecure:
+                client.tls_insecure_set(True)
+        client.reconnect_delay_set(min_delay, max_delay)
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_publish = self._on_publish
+        self.client = client
+
+    def start(self):
+        logger.info(f"Connecting to MQTT broker {self.broker['host']}")
+        self.client.connect_async(**self.broker)
+        self.client.loop_start()
+        self.thread = threading.Thread(
+            target=self._run, name="scan-publisher", daemon=True
+        )
+        self.thread.start()
+
+    def publish(self, topic, payload, qos=None):
+        """Queues payload (JSON encoded) for topic; returns False if dropped."""
+        logger.debug(f"Queueing MQTT message: {topic}")
+        logger.debug(payload)
+        if len(self.outbox) >= self.max_queued:
+            logger.error(f"MQTT outbox full, dropping message for {topic}")
+            self.stats["dropped"] += 1
+            return False
+        qos = self.qos if qos is None else qos
+        self.outbox.put(topic, json.dumps(payload), qos)
+        self.wakeup.set()
+        return True
+
+    def stop(self, timeout=5):
+        """Sends what is queued (for up to timeout seconds) and disconnects."""
+        deadline = time.monotonic() + timeout
+        while (
+            self.connected.is_set()
+            and len(self.outbox) > len(self.acked)
+            and time.monotonic() < deadline
+        ):
+            time.sleep(0.05)
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+        self._remove_acked()
+        if len(self.outbox):
+            logger.warning(
+                f"{len(self.outbox)} MQTT messages left in outbox {self.outbox.path}"
+            )
+        self.client.disconnect()
+        self.client.loop_stop()
+        self.outbox.close()
+
+    def _run(self):
+        while not self.stopping.is_set():
+            # Cleared before looking for work, so a publish() or ack that
+            # comes in meanwhile is not missed
+            self.wakeup.clear()
+            self._remove_acked()
+            with self.lock:
+                if self.rewind is not None:
+                    self.cursor = min(self.cursor, self.rewind)
+                    self.rewind = None
+                # Rows paho still holds (QoS 1 and 2, resent by paho after
+                # a reconnect) or that are acknowledged but not yet removed
+                skip = {entry[0] for entry in self.in_flight.values()}
+                skip.update(self.acked)
+            room = self.batch_size - len(self.in_flight)
+            rows = []
+            if self.connected.is_set() and room > 0:
+                rows = self.outbox.batch(self.cursor, room)
+            if not rows:
+                self.wakeup.wait(1)
+                continue
+            for row_id, topic, payload, qos in rows:
+                if row_id in skip:
+                    self.cursor = row_id
+                    continue
+                if not self._send(row_id, topic, payload, qos):
+                    time.sleep(0.1)
+                    break
+
+    def _send(self, row_id, topic, payload, qos):
+        sent = time.monotonic()
+        # Not under self.lock: paho takes its callback lock in publish(), and
+        # holds it while calling _on_publish
+        info = self.client.publish(topic, payload, qos=qos)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS and qos == 0:
+            # Disconnected; the message is sent from the outbox again after
+            # the reconnect.  paho keeps QoS 1 and 2 messages and resends
+            # them itself.
+            logger.debug(f"Not connected, holding message for {topic}")
+            return False
+        self.cursor = row_id
+        with self.lock:
+            acked = self.early_acks.pop(info.mid, None)
+            if acked is None:
+                self.in_flight[info.mid] = (row_id, qos, sent)
+                return True
+            self.acked.append(row_id)
+        self.publish_times.observe_since(sent, acked)
+        self.stats["published"] += 1
+        return True
+
+    def _remove_acked(self):
+        with self.lock:
+            acked, self.acked = self.acked, []
+        self.outbox.remove(acked)
+
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logger.error(f"MQTT connection refused: {mqtt.connack_string(rc)}")
+            return
+        if client.connect_started is not None:
+            self.connect_times.observe_since(client.connect_started, time.monotonic())
+        self.stats["connects"] += 1
+        logger.info(f"Connected to MQTT broker, {len(self.outbox)} messages queued")
+        self.connected.set()
+        self.wakeup.set()
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.connected.clear()
+        # paho discards QoS 0 packets it had not written yet, and they will
+        # never be acknowledged: send them from the outbox again
+        with self.lock:
+            lost = [mid for mid, entry in self.in_flight.items() if entry[1] == 0]
+            if lost:
+                first = min(self.in_flight[mid][0] for mid in lost)
+                for mid in lost:
+                    del self.in_flight[mid]
+                if self.rewind is None or first - 1 < self.rewind:
+                    self.rewind = first - 1
+        if rc != 0:
+            self.stats["disconnects"] += 1
+            logger.warning(f"MQTT connection lost: {mqtt.error_string(rc)}")
+
+    def _on_publish(self, client, userdata, mid):
+        acked = time.monotonic()
+        with self.lock:
+            entry = self.in_flight.pop(mid, None)
+            if entry is None:
+                self.early_acks[mid] = acked
+                return
+            row_id, qos, sent = entry
+            self.acked.append(row_id)
+        self.publish_times.observe_since(sent, acked)
+        self.stats["published"] += 1
+        self.wakeup.set()
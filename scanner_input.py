@@ -0,0 +1,194 @@
+"""Turns raw barcode scanner input into complete scans"""
+
+import logging
+import queue
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Scan suffixes scanners are commonly programmed to send
+SUFFIXES = {
+    "CR": b"\r",
+    "LF": b"\n",
+    "CRLF": b"\r\n",
+    "ETX": b"\x03",
+    "TAB": b"\t",
+    "NONE": None,
+}
+
+
+class SerialFramer(object):
+    """
+    Splits the byte stream from a serial scanner into scans.  A scan ends at
+    the suffix (the terminator the scanner is programmed to send), which is
+    removed from it, or when no byte arrives for gap_ms milliseconds.  AAMVA
+    licence barcodes (scans starting with "@") contain CRs in their header
+    and at the end of each subfile, so they end only at the gap.  CRs and LFs
+    left at the start of a scan, e.g. the LF of a CRLF suffix that arrived
+    after a CR suffix had ended the scan before it, are dropped.  Each read
+    takes everything the port has buffered.
+    """
+
+    def __init__(self, ser, suffix=b"\r", gap_ms=50):
+        self.ser = ser
+        self.suffix = suffix
+        self.gap = gap_ms / 1000.0
+        self.buffer = bytearray()
+        self.last_byte = None
+        # Empty reads return after this long, which bounds how late a gap is
+        # noticed
+        ser.timeout = self.gap
+
+    def _split(self):
+        """Returns the first scan in the buffer that ended at a suffix, or None."""
+        while self.suffix:
+            start = len(self.buffer) - len(self.buffer.lstrip(b"\r\n"))
+            del self.buffer[:start]
+            if self.buffer.startswith(b"@"):
+                return None
+            end = self.buffer.find(self.suffix)
+            if end < 0:
+                return None
+            scan = bytes(self.buffer[:end])
+            del self.buffer[: end + len(self.suffix)]
+            if scan:
+                return scan
+        return None
+
+    def _trim_suffix(self, scan):
+        """
+        Removes a trailing suffix from scan, or the start of one whose rest
+        did not arrive before the gap (it is dropped from the next scan).
+        """
+        if self.suffix:
+            for length in range(len(self.suffix), 0, -1):
+                if scan.endswith(self.suffix[:length]):
+                    return scan[:-length]
+        return scan
+
+    def read_scan(self):
+        """Blocks until a complete scan is available and returns its bytes."""
+        while True:
+            scan = self._split()
+            if scan is not None:
+                return scan
+
+            data = self.ser.read(self.ser.in_waiting or 1)
+            if data:
+                self.buffer += data
+                self.last_byte = time.monotonic()
+            elif self.buffer and time.monotonic() - self.last_byte >= self.gap:
+                scan = self._trim_suffix(bytes(self.buffer))
+                self.buffer.clear()
+                if scan.strip(b"\r\n"):
+                    return scan
+
+    def scans(self):
+        """Yields scans as they arrive."""
+        while True:
+            yield self.read_scan()
+
+
+class HIDScanReader(object):
+    """
+    Reads scans from a USB HID POS scanner (IBM SurePOS style reports) on a
+    background thread and queues them for read_scan().
+
+    Each input report carries a length byte (at length_byte) giving the
+    number of bytes that follow it.  The scan data starts header[0] bytes
+    into the first report of a scan and header[1] bytes into the reports
+    that continue it.  A scan is complete when a report's continuation flag
+    (continuation_byte & continuation_mask) is clear or, for scanners without
+    one, when a report is not full.  Reports are copied into one
+    preallocated buffer, so long PDF417 scans are not rebuilt per report.
+    """
+
+    def __init__(
+        self,
+        dev,
+        report_size=64,
+        length_byte=0,
+        header=(3, 1),
+        continuation_byte=None,
+        continuation_mask=0x01,
+        buffer_size=4096,
+        timeout_ms=1000,
+    ):
+        self.dev = dev
+        self.report_size = report_size
+        self.length_byte = length_byte
+        self.header = header
+        self.continuation_byte = continuation_byte
+        self.continuation_mask = continuation_mask
+        self.timeout_ms = timeout_ms
+        self.buffer = bytearray(buffer_size)
+        self.length = 0
+        self.reports = 0
+        self.scans = queue.Queue()
+        self.error = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._run, name="hid-scanner", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def read_scan(self):
+        """
+        Blocks until a complete scan is available and returns its bytes.
+        Raises the reader thread's error if it stopped because of one.
+        """
+        scan = self.scans.get()
+        if scan is None:
+            raise self.error
+        return scan
+
+    def _run(self):
+        try:
+            while not self.stopping.is_set():
+                report = self.dev.read(self.report_size, timeout=self.timeout_ms)
+                if report:
+                    self._add_report(report)
+                elif self.reports:
+                    # The scanner went quiet part way through a scan
+                    logger.warning(
+                        f"Incomplete HID scan after {self.reports} reports; "
+                        f"using {self.length} bytes"
+                    )
+                    self._finish_scan()
+        except Exception as e:
+            logger.error(f"HID scanner read failed: {e}")
+            self.error = e
+            self.scans.put(None)
+
+    def _add_report(self, report):
+        offset = self.header[0] if self.reports == 0 else self.header[1]
+        end = min(self.length_byte + 1 + report[self.length_byte], len(report))
+        size = max(0, end - offset)
+
+        if self.length + size > len(self.buffer):
+            self.buffer.extend(bytes(max(len(self.buffer), size)))
+        self.buffer[self.length : self.length + size] = report[offset:end]
+        self.length += size
+        self.reports += 1
+
+        if self.continuation_byte is not None:
+            complete = not report[self.continuation_byte] & self.continuation_mask
+        else:
+            complete = end < self.report_size
+        if complete:
+            self._finish_scan()
+
+    def _finish_scan(self):
+        if self.length:
+            self.scans.put(bytes(self.buffer[: self.length]))
+        self.length = 0
+        self.reports = 0
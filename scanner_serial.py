@@ -10,21 +10,41 @@ import serial
 from aamva import AAMVA
 from fhirclient import models
 from healthcards import cvx, parser
-from paho.mqtt import publish as mqtt
 
 import settings
+from scan_decoder import OrderedDecoder
+from scan_publisher import ScanPublisher
+from scanner_input import SUFFIXES, HIDScanReader, SerialFramer
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 eval_bool = lambda x: x.lower() in ("true", "1", "t", "y", "yes")
 
 SERIAL_READ_TIMEOUT = 1
+# Suffix the scanner is programmed to send after each scan (CR, LF, CRLF, ETX,
+# TAB or NONE), and the silence in milliseconds that ends a scan without one
+# (and every AAMVA licence scan)
+SCAN_SUFFIX = os.environ.get("SCAN_SUFFIX", "CR").upper()
+SCAN_GAP_MS = int(os.environ.get("SCAN_GAP_MS", "50"))
 USE_HID = os.environ.get("USE_HID", False)
 USE_MQTT = os.environ.get("USE_MQTT", True)
 
 vid = int(os.environ.get("VID", "0x05E0"), 16)
 pid = int(os.environ.get("PID", "0x0600"), 16)
 
+# HID report layout: header bytes before the data in the first and following
+# reports of a scan, and the byte and bit mask of the "more reports follow"
+# flag, if the scanner sets one (otherwise a short report ends the scan)
+HID_REPORT_HEADER = tuple(
+    int(n) for n in os.environ.get("HID_REPORT_HEADER", "3,1").split(",")
+)
+HID_CONTINUATION_BYTE = os.environ.get("HID_CONTINUATION_BYTE")
+HID_CONTINUATION_MASK = int(os.environ.get("HID_CONTINUATION_MASK", "0x01"), 16)
+
+# Threads decoding health cards and driver's licenses while the reader
+# keeps reading
+DECODE_WORKERS = int(os.environ.get("DECODE_WORKERS", "2"))
+
 if USE_HID:
     import hid
 
@@ -126,32 +146,6 @@ def check_shc(barcode_data):
     }
 
 
-def read_until_timeout(ser):
-    buffer = b""
-    while True:
-        char = ser.read(1)
-        if char:
-            buffer += char
-        else:
-            return buffer
-
-
-def blocking_hid_scan(dev):
-    buffer = b""
-    count = 0
-    while True:
-        read = dev.read(64, timeout=1000)
-        if read:
-            if count == 0:
-                buffer += read[3:]
-            else:
-                buffer += read[1:]
-            count += 1
-
-        if b"\0" * 4 in buffer[-32:]:
-            return buffer.strip(b"\0")
-
-
 def get_topic(command):
     base_topic = get_base_topic()
     return f"{base_topic}/{command}"
@@ -162,24 +156,75 @@ def get_base_topic():
 
 
 def send_mqtt_message(topic, payload):
-    logger.debug(f"Sending MQTT message: {topic}")
-    logger.debug(payload)
-
-    payload_json = json.dumps(payload)
-    options = {
-        "hostname": settings.MQTT_BROKER["host"],
-        "port": settings.MQTT_BROKER["port"],
-        "auth": settings.MQTT_LOGIN,
-        "retain": False,
-        "tls": settings.MQTT_TLS_CONTEXT,
-    }
+    publisher.publish(topic, payload)
+
 
-    mqtt.single(topic, payload_json, **options)
+def publish_shc(decoded_shc):
+    send_mqtt_message(get_topic("scan/shc"), decoded_shc)
+
+
+def open_url(url):
+    logger.info(url)
+    if USE_MQTT:
+        send_mqtt_message(get_topic("open"), {"url": url})
+    else:
+        webbrowser.open(url)
+
+
+def publish_id(dl):
+    print(f"{dl['first']} {dl['last']} {dl['dob'].isoformat()}")
+    if USE_MQTT:
+        payload = {
+            "first": dl["first"],
+            "last": dl["last"],
+            "middle": dl["middle"],
+            "dob": dl["dob"].isoformat(),
+            "expiry": dl["expiry"].isoformat(),
+            "address": dl["address"],
+            "address2": dl["address2"],
+            "city": dl["city"],
+            "state": dl["state"],
+            "ZIP": dl["ZIP"],
+            "country": dl["country"],
+        }
+        send_mqtt_message(get_topic("scan/id"), payload)
+
+
+def publish_text(text):
+    print(text)
+    send_mqtt_message(get_topic("scan"), {"text": text})
+
+
+def handle_scan(raw_input):
+    """
+    Classifies a scan on the reader thread and queues it with its decoder;
+    results are published in scan order as decoding finishes.
+    """
+    if SHC_REGEX.match(raw_input):
+        decoder.submit("shc", check_shc, raw_input, publish_shc)
+
+    elif URL_REGEX.match(raw_input):
+        decoder.submit("url", None, raw_input, open_url)
+
+    elif raw_input.startswith("@"):
+        decoder.submit("aamva", aamva.decode_barcode, raw_input, publish_id)
+
+    else:
+        decoder.submit("text", None, raw_input, publish_text)
 
 
 if __name__ == "__main__":
     if USE_HID:
         hid_dev = hid.Device(vid, pid)
+        scan_reader = HIDScanReader(
+            hid_dev,
+            header=HID_REPORT_HEADER,
+            continuation_byte=(
+                int(HID_CONTINUATION_BYTE) if HID_CONTINUATION_BYTE else None
+            ),
+            continuation_mask=HID_CONTINUATION_MASK,
+        )
+        scan_reader.start()
     else:
         ser = serial.Serial(
             os.environ.get("SERIAL_DEVICE", "/dev/ttyACM0"),
@@ -187,54 +232,46 @@ if __name__ == "__main__":
             rtscts=True,
             dsrdtr=True,
         )
+        framer = SerialFramer(ser, SUFFIXES[SCAN_SUFFIX], SCAN_GAP_MS)
 
     issuers = Issuers()
     aamva = AAMVA()
 
+    publisher = ScanPublisher(
+        settings.MQTT_BROKER,
+        login=settings.MQTT_LOGIN,
+        tls=settings.MQTT_TLS_CONTEXT,
+        **getattr(settings, "SCANNER_MQTT", {}),
+    )
+    publisher.start()
+    decoder = OrderedDecoder(DECODE_WORKERS)
+    decoder.start()
+
     while True:
         try:
             if USE_HID:
-                scan_read = blocking_hid_scan(hid_dev)
+                scan_read = scan_reader.read_scan()
             else:
-                scan_read = read_until_timeout(ser)
+                scan_read = framer.read_scan()
             if scan_read:
                 raw_input = scan_read.decode("latin1")
-                if SHC_REGEX.match(raw_input):
-                    decoded_shc = check_shc(raw_input)
-                    send_mqtt_message(get_topic("scan/shc"), decoded_shc)
-
-                elif URL_REGEX.match(raw_input):
-                    logger.info(raw_input)
-                    if USE_MQTT:
-                        send_mqtt_message(get_topic("open"), {"url": raw_input})
-                    else:
-                        webbrowser.open(raw_input)
-
-                elif raw_input.startswith("@"):
-                    dl = aamva.decode_barcode(raw_input)
-                    print(f"{dl['first']} {dl['last']} {dl['dob'].isoformat()}")
-                    if USE_MQTT:
-                        payload = {
-                            "first": dl["first"],
-                            "last": dl["last"],
-                            "middle": dl["middle"],
-                            "dob": dl["dob"].isoformat(),
-                            "expiry": dl["expiry"].isoformat(),
-                            "address": dl["address"],
-                            "address2": dl["address2"],
-                            "city": dl["city"],
-                            "state": dl["state"],
-                            "ZIP": dl["ZIP"],
-                            "country": dl["country"],
-                        }
-                        send_mqtt_message(get_topic("scan/id"), payload)
-
-                else:
-                    print(raw_input)
-                    send_mqtt_message(get_topic("scan"), {"text": raw_input})
+                try:
+                    handle_scan(raw_input)
+                except Exception:
+                    logger.exception("Could not handle scan")
 
         except KeyboardInterrupt:
             if USE_HID:
-                hid.close()
+                scan_reader.stop()
+                hid_dev.close()
             else:
                 ser.close()
+            decoder.stop()
+            for timing in decoder.timings.values():
+                logger.info(timing)
+            logger.info(decoder.scan_times)
+            publisher.stop()
+            logger.info(publisher.connect_times)
+            logger.info(publisher.publish_times)
+            logger.info(f"MQTT publisher stats: {publisher.stats}")
+            break
@@ -0,0 +1,225 @@
+"""Scratch space for badge render artifacts, kept in RAM where available"""
+
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from metrics import LatencyHistogram
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# tmpfs on Linux; HTML, PDFs and images written here never touch the disk
+RAM_DIRECTORY = "/dev/shm"
+
+PREFIX = "apis-"
+
+# Held locked by the process using a workspace, so other processes sharing
+# the root leave it alone
+LOCK_FILE = ".owner"
+
+
+def default_root():
+    if os.path.isdir(RAM_DIRECTORY) and os.access(RAM_DIRECTORY, os.W_OK):
+        return RAM_DIRECTORY
+    return tempfile.gettempdir()
+
+
+def _in_use(path):
+    """Returns True if the workspace at path belongs to a running process."""
+    lock_path = os.path.join(path, LOCK_FILE)
+    if not os.path.exists(lock_path):
+        return False
+    if fcntl is None:
+        # Can't tell, so only the owner removes it
+        return True
+    try:
+        with open(lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return True
+    return False
+
+
+class JobWorkspace(object):
+    """
+    A directory for the files of one render job, removed with everything in
+    it when the job is closed.  Use as a context manager.
+    """
+
+    def __init__(self, workspace, name):
+        self.workspace = workspace
+        self.name = name
+        self.path = tempfile.mkdtemp(prefix=f"{name}-", dir=workspace.path)
+        self.started = time.monotonic()
+        self.closed = False
+
+    def file(self, suffix="", prefix="apis"):
+        """Creates an empty file in the job directory and returns its path."""
+        fd, path = tempfile.mkstemp(suffix=suffix, prefix=prefix, dir=self.path)
+        os.close(fd)
+        return path
+
+    def detach(self, path):
+        """
+        Moves a file out of the job directory so it outlives the job (e.g. a
+        PDF handed to a viewer).  It is removed by the workspace's age and
+        size limits instead.
+        """
+        target = os.path.join(self.workspace.path, os.path.basename(path))
+        os.replace(path, target)
+        return target
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.workspace._finish(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Workspace(object):
+    """
+    Hands out per-job directories under one directory in root (/dev/shm by
+    default) and enforces limits on it: files older than max_age seconds are
+    deleted, and the oldest files are deleted while the total exceeds
+    max_bytes.  Files of running jobs are never collected.  Limits are
+    checked whenever a job starts.  Workspaces left in root by processes
+    that have exited are removed once they are max_age seconds old; ones
+    whose process still holds their LOCK_FILE are kept.  A missing root is
+    created.
+    """
+
+    def __init__(self, root=None, max_bytes=256 * 1024 * 1024, max_age=3600):
+        self.root = self._make_root(root or default_root())
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.jobs = set()
+        self.stats = {
+            "jobs": 0,
+            "active_jobs": 0,
+            "files": 0,
+            "bytes": 0,
+            "peak_bytes": 0,
+            "collected_files": 0,
+            "collected_bytes": 0,
+        }
+        self.job_times = LatencyHistogram("render job")
+
+        self._remove_stale()
+        self.path = tempfile.mkdtemp(prefix=PREFIX, dir=self.root)
+        self.owner = open(os.path.join(self.path, LOCK_FILE), "w")
+        self.owner.write(f"{os.getpid()}\n")
+        self.owner.flush()
+        if fcntl is not None:
+            fcntl.flock(self.owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        logger.info(f"Render workspace is {self.path}")
+
+    @staticmethod
+    def _make_root(root):
+        """Creates root if needed, falling back to the system temp directory."""
+        try:
+            os.makedirs(root, exist_ok=True)
+        except OSError as e:
+            fallback = tempfile.gettempdir()
+            logger.warning(
+                f"Unable to create render workspace root {root}, using "
+                f"{fallback}: {e}"
+            )
+            return fallback
+        return root
+
+    def _remove_stale(self):
+        """
+        Removes workspaces left in root by processes that did not exit
+        cleanly: those older than max_age whose owner no longer holds their
+        lock file.
+        """
+        cutoff = time.time() - self.max_age
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                stale = name.startswith(PREFIX) and os.stat(path).st_mtime < cutoff
+            except OSError:
+                continue
+            if stale and os.path.isdir(path) and not _in_use(path):
+                logger.info(f"Removing stale render workspace {path}")
+                shutil.rmtree(path, ignore_errors=True)
+
+    def job(self, name="job"):
+        """Returns a new JobWorkspace, after enforcing the limits."""
+        self.collect()
+        job = JobWorkspace(self, name)
+        with self.lock:
+            self.jobs.add(job.path)
+            self.stats["jobs"] += 1
+            self.stats["active_jobs"] = len(self.jobs)
+        return job
+
+    def _finish(self, job):
+        shutil.rmtree(job.path, ignore_errors=True)
+        self.job_times.observe_since(job.started, time.monotonic())
+        with self.lock:
+            self.jobs.discard(job.path)
+            self.stats["active_jobs"] = len(self.jobs)
+
+    def _files(self):
+        """Returns (mtime, size, path) for every file not owned by a running job."""
+        with self.lock:
+            active = set(self.jobs)
+        files = []
+        for directory, dirs, names in os.walk(self.path):
+            dirs[:] = [d for d in dirs if os.path.join(directory, d) not in active]
+            for name in names:
+                if name == LOCK_FILE and directory == self.path:
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    def collect(self):
+        """Deletes files past max_age, then the oldest while over max_bytes."""
+        files = sorted(self._files())
+        cutoff = time.time() - self.max_age
+        total = peak = sum(size for mtime, size, path in files)
+        removed = removed_bytes = 0
+        for mtime, size, path in files:
+            if mtime >= cutoff and total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+            removed_bytes += size
+
+        if removed:
+            logger.info(f"Removed {removed} render files ({removed_bytes} bytes)")
+        with self.lock:
+            self.stats["files"] = len(files) - removed
+            self.stats["bytes"] = total
+            self.stats["peak_bytes"] = max(self.stats["peak_bytes"], peak)
+            self.stats["collected_files"] += removed
+            self.stats["collected_bytes"] += removed_bytes
+
+    def close(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.owner.close()